@@ -0,0 +1,198 @@
+import argparse
+import base64
+import json
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from perception import perspect_transform, color_thresh, rover_coords, pix_to_world, \
+                       to_polar_coords, perception_step, source, destination, world_scale, \
+                       perception_modes, get_warp_table
+from supporting_functions import update_rover, create_output_images
+from drive_rover import RoverState
+from instrumentation import StageTimer
+from replay import read_log, read_image, synthesize_telemetry
+
+# Functions timed on every frame, in pipeline order
+benchmark_stages = ['perspect_transform', 'color_thresh', 'pix_to_world', 'to_polar_coords',
+                    'update_rover', 'perception_step', 'create_output_images']
+# Stages that make up the per-frame drive loop work, used for frames/sec
+pipeline_stages = ['update_rover', 'perception_step', 'create_output_images']
+
+# Define a function to load the dataset frames used by the benchmark.
+# With frames larger than the dataset the log is cycled with a seeded jitter
+# on position and yaw so the synthesized frames keep spreading over the map.
+def load_frames(log, frames=None, seed=0):
+    records = read_log(log)
+    images = [read_image(record.path) for record in records]
+    image_strings = []
+    for record in records:
+        with open(record.path, 'rb') as f:
+            image_strings.append(base64.b64encode(f.read()).decode('utf-8'))
+    if frames is None or frames <= len(records):
+        count = len(records) if frames is None else frames
+        return [(records[idx], images[idx], image_strings[idx]) for idx in range(count)]
+    rng = np.random.RandomState(seed)
+    dataset = []
+    for idx in range(frames):
+        record = records[idx % len(records)]
+        if idx >= len(records):
+            record = record._replace(xpos=float(np.clip(record.xpos + rng.uniform(-40, 40), 0, 199)),
+                                     ypos=float(np.clip(record.ypos + rng.uniform(-40, 40), 0, 199)),
+                                     yaw=float((record.yaw + rng.uniform(0, 360)) % 360))
+        dataset.append((record, images[idx % len(records)], image_strings[idx % len(records)]))
+    return dataset
+
+# Define a function to run each benchmarked function over one frame
+def run_frame(Rover, record, img, image_string, timer):
+    with timer.stage('perspect_transform'):
+        warped = perspect_transform(img, source, destination)
+    with timer.stage('color_thresh'):
+        threshed = color_thresh(warped)
+    xpix, ypix = rover_coords(threshed)
+    with timer.stage('pix_to_world'):
+        pix_to_world(xpix, ypix, record.xpos, record.ypos, record.yaw,
+                     Rover.worldmap.shape[0], world_scale)
+    with timer.stage('to_polar_coords'):
+        to_polar_coords(xpix, ypix)
+    data = synthesize_telemetry(record, image_string)
+    with timer.stage('update_rover'):
+        update_rover(Rover, data)
+    with timer.stage('perception_step'):
+        perception_step(Rover)
+    with timer.stage('create_output_images'):
+        create_output_images(Rover)
+
+# Define a function to benchmark the dataset and return the results
+def run_benchmark(dataset, memory_frames=50):
+    # Timing pass
+    timer = StageTimer(window=len(dataset))
+    Rover = RoverState()
+    # Time the full perception work on every frame
+    Rover.pose_gate = None
+    for record, img, image_string in dataset:
+        run_frame(Rover, record, img, image_string, timer)
+    stages = timer.summary()
+    pipeline_ms = sum(stages[name]['mean_ms'] for name in pipeline_stages)
+    # Separate (shorter) pass for peak memory, since tracing slows everything down
+    tracemalloc.start()
+    Rover = RoverState()
+    Rover.pose_gate = None
+    for record, img, image_string in dataset[:memory_frames]:
+        run_frame(Rover, record, img, image_string, StageTimer())
+    peak_traced = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+    return {
+        'frames': len(dataset),
+        'fps': round(1000 / pipeline_ms, 2),
+        'stages': stages,
+        'peak_traced_mb': round(peak_traced / 2**20, 2),
+        'max_rss_mb': round(max_rss / 2**20, 2),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+    }
+
+# Define a function to run perception over the dataset in each perception
+# mode and return its perception_step latency with the map coverage and
+# fidelity it reaches (the metrics shown by create_output_images)
+def compare_modes(dataset, modes):
+    results = {}
+    for mode in modes:
+        timer = StageTimer(window=len(dataset))
+        Rover = RoverState()
+        Rover.perception_mode = mode
+        Rover.pose_gate = None
+        for record, img, image_string in dataset:
+            Rover.img = img
+            Rover.pos = (record.xpos, record.ypos)
+            Rover.yaw = record.yaw
+            with timer.stage('perception_step'):
+                perception_step(Rover)
+        stats = timer.summary()['perception_step']
+        results[mode] = {'pixels': len(get_warp_table(mode).src_index),
+                         'p50_ms': stats['p50_ms'],
+                         'mean_ms': stats['mean_ms'],
+                         'mapped': Rover.map_stats.perc_mapped(),
+                         'fidelity': Rover.map_stats.fidelity()}
+    return results
+
+def print_modes(results):
+    print("{:>10} {:>9} {:>9} {:>10} {:>10}".format('mode', 'pixels', 'p50 ms', 'mapped %', 'fidelity %'))
+    for mode, stats in results.items():
+        print("{:>10} {:>9} {:>9.3f} {:>10} {:>10}".format(
+            mode, stats['pixels'], stats['p50_ms'], stats['mapped'], stats['fidelity']))
+
+# Define a function to compare results against a saved baseline and return
+# a list of regressions (stage p50 latencies or fps worse than tolerance)
+def find_regressions(results, baseline, tolerance=0.2):
+    regressions = []
+    for name, stats in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        base_p50 = baseline['stages'][name]['p50_ms']
+        if stats['p50_ms'] > base_p50 * (1 + tolerance):
+            regressions.append('{}: p50 {:.3f} ms vs baseline {:.3f} ms'.format(
+                name, stats['p50_ms'], base_p50))
+    if results['fps'] < baseline['fps'] * (1 - tolerance):
+        regressions.append('fps: {:.1f} vs baseline {:.1f}'.format(results['fps'], baseline['fps']))
+    return regressions
+
+def print_results(results):
+    print("{:>22} {:>9} {:>9} {:>9} {:>9}".format('stage', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name in benchmark_stages:
+        stats = results['stages'][name]
+        print("{:>22} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+            name, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['max_ms']))
+    print("Frames: {}, pipeline frames/sec: {}".format(results['frames'], results['fps']))
+    print("Peak traced memory: {} MB, max RSS: {} MB".format(
+        results['peak_traced_mb'], results['max_rss_mb']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Perception, mapping and output benchmark')
+    parser.add_argument(
+        'log',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv to replay.'
+    )
+    parser.add_argument('--frames', type=int, default=None,
+                        help='Number of frames to run; larger than the log synthesizes frames.')
+    parser.add_argument('--save', type=str, default='',
+                        help='Save the results as a JSON baseline to this file.')
+    parser.add_argument('--compare', type=str, default='',
+                        help='Compare the results against this JSON baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed fractional slowdown before flagging a regression.')
+    parser.add_argument('--modes', type=str, nargs='*', default=None,
+                        choices=sorted(perception_modes),
+                        help='Also compare perception speed and map fidelity of these '
+                             'perception modes (all modes if none are listed).')
+    args = parser.parse_args()
+
+    dataset = load_frames(args.log, args.frames)
+    start = time.time()
+    results = run_benchmark(dataset)
+    print_results(results)
+    print("Benchmark took {:.1f} s".format(time.time() - start))
+    if args.modes is not None:
+        print_modes(compare_modes(dataset, args.modes or list(perception_modes)))
+    if args.save != '':
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved baseline to {}".format(args.save))
+    if args.compare != '':
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against {}".format(args.compare))
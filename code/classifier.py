@@ -0,0 +1,135 @@
+import argparse
+import glob
+from collections import namedtuple
+import numpy as np
+import cv2
+
+# A color rule adds the pixels whose color lies strictly between low and high
+# in every channel of the given color space ('rgb', or 'hsv' with OpenCV's
+# 0-179 hue) to the class `label` (0: obstacle, 1: rock sample, 2: navigable
+# terrain, the channel order of Rover.vision_image).  An inverted rule adds
+# the pixels outside the range instead.
+ColorRule = namedtuple('ColorRule', ['label', 'low', 'high', 'space', 'invert'])
+
+# The default rules reproduce classify_pixels(): navigable terrain is bright
+# ground, obstacles are everything else and rock samples are yellow
+default_rules = [
+    ColorRule(2, (160, 160, 160), (256, 256, 256), 'rgb', False),
+    ColorRule(0, (160, 160, 160), (256, 256, 256), 'rgb', True),
+    ColorRule(1, (110, 110, 0), (255, 255, 50), 'rgb', False),
+]
+
+# Define a function to build rules like the given ones but with the
+# navigable terrain (and obstacle) threshold at rgb_thresh, the threshold
+# of color_thresh()
+def threshold_rules(rgb_thresh, rules=default_rules):
+    rgb_thresh = tuple(int(value) for value in np.broadcast_to(rgb_thresh, 3))
+    return [ColorRule(2, rgb_thresh, (256, 256, 256), 'rgb', False),
+            ColorRule(0, rgb_thresh, (256, 256, 256), 'rgb', True)] \
+         + [rule for rule in rules if rule.label == 1]
+
+# Define a class that compiles a set of color rules into a lookup table of
+# class bits (bit N set for class N) indexed by the quantized RGB color.
+# With bits=8 the table covers all 256^3 colors exactly (16 MB); with fewer
+# bits each table entry holds the classes of the center color of its bin.
+# Labeling a frame is then one index computation and one gather per pixel,
+# whatever the number of rules.
+class ColorClassifier():
+    def __init__(self, rules=default_rules, bits=8):
+        self.rules = list(rules)
+        self.bits = bits
+        self.shift = 8 - bits
+        levels = 1 << bits
+        # Representative 8-bit value of each quantization level
+        values = (np.arange(levels) << self.shift) + ((1 << self.shift) >> 1)
+        hsv = None
+        lut = np.zeros((levels, levels, levels), dtype=np.uint8)
+        for rule in self.rules:
+            if rule.space == 'rgb':
+                # RGB boxes are separable, so combine one range test per channel
+                inside = [(values > rule.low[channel]) & (values < rule.high[channel])
+                          for channel in range(3)]
+                selected = inside[0][:, None, None] & inside[1][None, :, None] \
+                         & inside[2][None, None, :]
+            else:
+                if hsv is None:
+                    red, green, blue = np.meshgrid(values, values, values, indexing='ij')
+                    rgb = np.stack((red, green, blue), axis=-1).astype(np.uint8)
+                    hsv = cv2.cvtColor(rgb.reshape(-1, 1, 3), cv2.COLOR_RGB2HSV).reshape(rgb.shape)
+                selected = np.all((hsv > rule.low) & (hsv < rule.high), axis=-1)
+            if rule.invert:
+                selected = ~selected
+            lut[selected] |= np.uint8(1 << rule.label)
+        self.lut = lut.ravel()
+
+    # Return the class bits of an (..., 3) array of RGB uint8 pixels
+    def labels(self, pixels):
+        if self.shift:
+            pixels = pixels >> self.shift
+        index = pixels[..., 0].astype(np.uint32)
+        index <<= self.bits
+        index |= pixels[..., 1]
+        index <<= self.bits
+        index |= pixels[..., 2]
+        return self.lut.take(index)
+
+    # Return boolean navigable, obstacle and rock masks (like classify_pixels)
+    def classify(self, pixels):
+        labels = self.labels(pixels)
+        return (labels & 4) > 0, (labels & 1) > 0, (labels & 2) > 0
+
+# Define a function to fit an HSV rock rule to example rock images.  Pixels
+# with a saturated yellow hue (the seed range) are taken as rock pixels and
+# the rule spans the given percentiles of their HSV values, widened by margin.
+def fit_rock_rule(images, seed_low=(15, 100, 60), seed_high=(40, 256, 256),
+                  percentiles=(1, 99), margin=(2, 10, 10)):
+    samples = []
+    for img in images:
+        hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV).reshape(-1, 3)
+        seed = np.all((hsv > seed_low) & (hsv < seed_high), axis=1)
+        samples.append(hsv[seed])
+    samples = np.concatenate(samples)
+    if len(samples) == 0:
+        raise ValueError('No rock colored pixels found in the calibration images')
+    low, high = np.percentile(samples, percentiles, axis=0)
+    low = np.maximum(np.floor(low) - margin - 1, -1).astype(int)
+    high = np.minimum(np.ceil(high) + margin + 1, 256).astype(int)
+    return ColorRule(1, tuple(low.tolist()), tuple(high.tolist()), 'hsv', False)
+
+# Define a function to read calibration images (RGB) matching a glob pattern
+def read_images(pattern):
+    return [cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB) for path in sorted(glob.glob(pattern))]
+
+# Define a function to build the default rules with the rock rule fitted to
+# the calibration images matching pattern
+def load_calibrated_rules(pattern='../calibration_images/example_rock*.jpg'):
+    images = read_images(pattern)
+    if not images:
+        raise IOError('No calibration images match {}'.format(pattern))
+    return [rule for rule in default_rules if rule.label != 1] + [fit_rock_rule(images)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit color rules to calibration images')
+    parser.add_argument(
+        'rocks',
+        type=str,
+        nargs='?',
+        default='../calibration_images/example_rock*.jpg',
+        help='Glob pattern of example rock images.'
+    )
+    parser.add_argument(
+        '--background',
+        type=str,
+        default='../calibration_images/example_grid*.jpg',
+        help='Glob pattern of images without rocks, to count false detections.'
+    )
+    args = parser.parse_args()
+
+    rules = load_calibrated_rules(args.rocks)
+    print("Fitted rock rule: {}".format(rules[-1]))
+    fitted, default = ColorClassifier(rules), ColorClassifier()
+    for name, pattern in (('rock', args.rocks), ('background', args.background)):
+        for img in read_images(pattern):
+            print("{} image: default rule {} rock pixels, fitted rule {}".format(
+                name, np.count_nonzero(default.classify(img)[2]),
+                np.count_nonzero(fitted.classify(img)[2])))
@@ -1,5 +1,50 @@
 import numpy as np
+from perception import nav_angle_edges
 
+# Define a function to return the angle (radians) below which the given
+# fraction of navigable terrain lies, interpolated within its histogram bin
+def hist_quantile(nav, fraction):
+    cumulative = np.cumsum(nav.angle_hist)
+    target = fraction * nav.count
+    idx = min(np.searchsorted(cumulative, target), len(nav.angle_hist) - 1)
+    below = cumulative[idx] - nav.angle_hist[idx]
+    within = (target - below) / max(nav.angle_hist[idx], 1)
+    return nav_angle_edges[idx] + within * (nav_angle_edges[idx + 1] - nav_angle_edges[idx])
+
+# Define a function to return the center angle (radians) of the widest run
+# of histogram bins with at least min_pixels navigable pixels each (ties go
+# to the run with more pixels), or None if no bin is open
+def widest_gap(nav, min_pixels):
+    is_open = np.concatenate(([0], (nav.angle_hist >= min_pixels).astype(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(is_open))
+    if len(edges) == 0:
+        return None
+    # Runs are [start, stop) bin ranges
+    starts, stops = edges[::2], edges[1::2]
+    cumulative = np.concatenate(([0], np.cumsum(nav.angle_hist)))
+    pixels = cumulative[stops] - cumulative[starts]
+    best = max(range(len(starts)), key=lambda idx: (stops[idx] - starts[idx], pixels[idx]))
+    return (nav_angle_edges[starts[best]] + nav_angle_edges[stops[best]]) / 2
+
+# Define a function to choose a steering angle (degrees, clipped to +/- 15)
+# from the navigable terrain summary according to Rover.steer_mode:
+#   'mean': the mean angle of navigable terrain
+#   'wall': the angle below which Rover.wall_fraction of navigable terrain
+#           lies, which keeps the rover near the wall on its left
+#   'gap': the center of the widest opening in the angle histogram
+#   'plan': the heading of the planner's waypoint (Rover.waypoint_heading),
+#           falling back to the mean angle without a waypoint
+def steer_angle(Rover, nav):
+    angle = nav.mean_angle
+    if Rover.steer_mode == 'plan' and Rover.waypoint_heading is not None:
+        angle = np.radians(Rover.waypoint_heading)
+    elif Rover.steer_mode == 'wall':
+        angle = hist_quantile(nav, Rover.wall_fraction)
+    elif Rover.steer_mode == 'gap':
+        gap = widest_gap(nav, Rover.gap_min_pixels)
+        if gap is not None:
+            angle = gap
+    return np.clip(angle * 180/np.pi, -15, 15)
 
 # This is where you can build a decision tree for determining throttle, brake and steer 
 # commands based on the output of the perception_step() function
@@ -11,11 +56,12 @@ def decision_step(Rover):
 
     # Example:
     # Check if we have vision data to make decisions with
-    if Rover.nav_angles is not None:
+    nav = Rover.nav_summary
+    if nav is not None:
         # Check for Rover.mode status
         if Rover.mode == 'forward': 
             # Check the extent of navigable terrain
-            if len(Rover.nav_angles) >= Rover.stop_forward:  
+            if nav.count >= Rover.stop_forward:  
                 # If mode is forward, navigable terrain looks good 
                 # and velocity is below max, then throttle 
                 if Rover.vel < Rover.max_vel:
@@ -24,10 +70,10 @@ def decision_step(Rover):
                 else: # Else coast
                     Rover.throttle = 0
                 Rover.brake = 0
-                # Set steering to average angle clipped to the range +/- 15
-                Rover.steer = np.clip(np.mean(Rover.nav_angles * 180/np.pi), -15, 15)
+                # Set steering to the chosen angle clipped to the range +/- 15
+                Rover.steer = steer_angle(Rover, nav)
             # If there's a lack of navigable terrain pixels then go to 'stop' mode
-            elif len(Rover.nav_angles) < Rover.stop_forward:
+            elif nav.count < Rover.stop_forward:
                     # Set mode to "stop" and hit the brakes!
                     Rover.throttle = 0
                     # Set brake to stored brake value
@@ -45,20 +91,24 @@ def decision_step(Rover):
             # If we're not moving (vel < 0.2) then do something else
             elif Rover.vel <= 0.2:
                 # Now we're stopped and we have vision data to see if there's a path forward
-                if len(Rover.nav_angles) < Rover.go_forward:
+                if nav.count < Rover.go_forward:
                     Rover.throttle = 0
                     # Release the brake to allow turning
                     Rover.brake = 0
                     # Turn range is +/- 15 degrees, when stopped the next line will induce 4-wheel turning
-                    Rover.steer = -15 # Could be more clever here about which way to turn
+                    Rover.steer = -15
+                    # When planning, turn towards the waypoint instead
+                    if Rover.steer_mode == 'plan' and Rover.waypoint_heading is not None \
+                            and Rover.waypoint_heading > 0:
+                        Rover.steer = 15
                 # If we're stopped but see sufficient navigable terrain in front then go!
-                if len(Rover.nav_angles) >= Rover.go_forward:
+                if nav.count >= Rover.go_forward:
                     # Set throttle back to stored value
                     Rover.throttle = Rover.throttle_set
                     # Release the brake
                     Rover.brake = 0
-                    # Set steer to mean angle
-                    Rover.steer = np.clip(np.mean(Rover.nav_angles * 180/np.pi), -15, 15)
+                    # Set steer to the chosen angle
+                    Rover.steer = steer_angle(Rover, nav)
                     Rover.mode = 'forward'
     # Just to make the rover do something 
     # even if no modifications have been made to the code
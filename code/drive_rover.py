@@ -2,25 +2,34 @@
 import argparse
 import shutil
 import base64
-from datetime import datetime
 import os
 import cv2
 import numpy as np
 import socketio
 import eventlet
 import eventlet.wsgi
+import eventlet.semaphore
+from eventlet import tpool
 from PIL import Image
 from flask import Flask
 from io import BytesIO, StringIO
 import json
 import pickle
-import matplotlib.image as mpimg
+import atexit
+import itertools
 import time
 
 # Import functions for perception and decision making
-from perception import perception_step
+from perception import perception_step, perception_modes, PoseGate
 from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from supporting_functions import update_rover, MapStats, TelemetryDecoder, convert_to_float
+from hud import HudEncoder
+from planner import Planner
+from classifier import ColorClassifier, load_calibrated_rules
+from worldmap import new_worldmap, load_ground_truth, MapRenderer
+from instrumentation import StageTimer
+from recording import Recorder, make_record
+from shared_state import SharedStatePublisher
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
@@ -29,11 +38,12 @@ app = Flask(__name__)
 # Read in ground truth map and create 3-channel green version for overplotting
 # NOTE: images are read in by default with the origin (0, 0) in the upper left
 # and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
+# The ground truth service is loaded once and shared by every rover.  Its
+# image has zeros in the red and blue channels and the map in the green
+# channel.  This is why the underlying map output looks green in the
+# display image
+ground_truth = load_ground_truth('../calibration_images/map_bw.png')
+ground_truth_3d = ground_truth.image
 
 # Define RoverState() class to retain rover state parameters
 class RoverState():
@@ -51,6 +61,12 @@ class RoverState():
         self.brake = 0 # Current brake value
         self.nav_angles = None # Angles of navigable terrain pixels
         self.nav_dists = None # Distances of navigable terrain pixels
+        self.nav_summary = None # Compact summary of navigable terrain (NavSummary)
+        self.perception_mode = 'full' # Perception footprint (see perception_modes)
+        # Skips mapping frames with too much pitch/roll and perceiving frames
+        # from an unchanged pose (None to integrate every frame)
+        self.pose_gate = PoseGate()
+        self.classifier = None # Color classifier (ColorClassifier), None for the default
         self.ground_truth = ground_truth_3d # Ground truth worldmap
         self.mode = 'forward' # Current mode (can be forward or stop)
         self.throttle_set = 0.2 # Throttle setting when accelerating
@@ -62,14 +78,30 @@ class RoverState():
         self.stop_forward = 50 # Threshold to initiate stopping
         self.go_forward = 500 # Threshold to go forward again
         self.max_vel = 2 # Maximum velocity (meters/second)
+        # Steering strategy: 'mean' (mean navigable angle), 'wall' (follow
+        # the left wall), 'gap' (head for the widest opening) or 'plan'
+        # (head for the planner's waypoint)
+        self.steer_mode = 'mean'
+        self.wall_fraction = 0.75 # Fraction of navigable terrain to the right in 'wall' mode
+        self.gap_min_pixels = 50 # Navigable pixels for a histogram bin to count as open
+        self.planner = None # Frontier planner over the worldmap (Planner), if enabled
+        self.waypoint = None # Planned waypoint (x, y) in meters
+        self.waypoint_heading = None # Heading to the waypoint relative to yaw (degrees)
+        self.plan_time = 0 # Time spent planning on the last frame (seconds)
         # Image output from perception step
         # Update this image to display your intermediate analysis steps
         # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.float64)
+        self.vision_version = 0 # Incremented whenever vision_image is updated
         # Worldmap
         # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float) 
+        # obstacles and rock samples (saturating uint16 evidence counters,
+        # use a larger size for more than one cell per meter)
+        self.worldmap = new_worldmap(200)
+        # Renderer for the worldmap display image
+        self.map_renderer = MapRenderer(ground_truth)
+        # Incremental statistics of the worldmap against the ground truth
+        self.map_stats = MapStats(ground_truth)
         self.samples_pos = None # To store the actual sample positions
         self.samples_to_find = 0 # To store the initial count of samples
         self.samples_located = 0 # To store number of samples located on map
@@ -77,88 +109,280 @@ class RoverState():
         self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
         self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
         self.send_pickup = False # Set to True to trigger rock pickup
-# Initialize our rover 
-Rover = RoverState()
+# Define RoverSession() class to hold the state of one connected simulator.
+# Every socket.io client (sid) gets its own RoverState, telemetry decoder
+# (with its own image buffer), inset image encoder and FPS counters, while
+# the imported modules and the ground truth map are shared.
+class RoverSession():
+    def __init__(self, sid):
+        self.sid = sid
+        self.Rover = RoverState()
+        self.Rover.perception_mode = args.perception_mode
+        self.Rover.pose_gate = PoseGate(args.max_tilt) if args.max_tilt > 0 else None
+        self.Rover.classifier = calibrated_classifier
+        if args.plan:
+            self.Rover.planner = Planner()
+            self.Rover.steer_mode = 'plan'
+        self.decoder = TelemetryDecoder(verbose=args.verbose, timing=args.decode_timing)
+        self.hud = HudEncoder(args.hud_rate)
+        # Frames from one simulator are processed one at a time
+        self.lock = eventlet.semaphore.Semaphore()
+        # Latest frame scheduling (--latest_frame)
+        self.busy = False # A frame is being processed
+        self.pending = None # Newest frame waiting to be processed
+        self.dropped = 0 # Frames dropped in the current second
+        self.last_commands = (0, 0, 0) # Last (throttle, brake, steer) sent
+        self.telemetry = (0, 0, 0) # (throttle, brake, steer) reported with the last frame
+        self.frames_in_flight = 0 # Frames being processed
+        self.closing = False # Set when the simulator disconnects
+        self.number = next(session_numbers)
+        # Recording of frames, telemetry and commands (if a folder was given)
+        self.recorder = None
+        if args.image_folder != '':
+            self.recorder = Recorder(os.path.join(args.image_folder, 'rover_{}'.format(self.number)))
+        # Shared memory block with the latest state (if a name was given)
+        self.publisher = None
+        if args.shared_memory != '':
+            self.publisher = SharedStatePublisher('{}_{}'.format(args.shared_memory, self.number),
+                                                  world_size=self.Rover.worldmap.shape[0])
+        # Variables to track frames per second (FPS)
+        self.frame_counter = 0
+        self.second_counter = time.time()
+        self.fps = None
+
+    # Do a rough calculation of frames per second (FPS)
+    def count_frame(self):
+        self.frame_counter += 1
+        if (time.time() - self.second_counter) > 1:
+            self.fps = self.frame_counter
+            self.frame_counter = 0
+            self.second_counter = time.time()
+            if args.latest_frame:
+                print("Rover {} FPS: {}, dropped: {}".format(self.sid, self.fps, self.dropped))
+                self.dropped = 0
+            else:
+                print("Rover {} FPS: {}".format(self.sid, self.fps))
+            if self.Rover.planner is not None:
+                print("Planning time: {:.2f} ms".format(self.Rover.plan_time * 1000))
+            if self.Rover.pose_gate is not None:
+                print("Perception integrated: {}, skipped: {}".format(
+                    self.Rover.pose_gate.integrated, self.Rover.pose_gate.skipped))
+            if self.decoder.timing:
+                print("Decode time per field (us): {}".format(
+                    {key: round(value, 1) for key, value in self.decoder.timing_report().items()}))
+
+    # Flush the recording, stop the inset image encoder and release the
+    # shared memory block.  Writing out the queued frames can take a while,
+    # so unless block is set this waits for it on a worker thread rather
+    # than holding up the other simulators.
+    def close(self, block=False):
+        self.hud.close()
+        if self.recorder is not None:
+            if block:
+                self.recorder.close()
+            else:
+                tpool.execute(self.recorder.close)
+            if self.recorder.dropped or self.recorder.failed:
+                print("Rover {} recording: {} frames dropped, {} failed to write".format(
+                    self.sid, self.recorder.dropped, self.recorder.failed))
+        if self.publisher is not None:
+            self.publisher.close()
+
+# Connected simulators by socket.io session id
+sessions = {}
+# Classifier with the rock rule fitted to calibration images (--rock_calibration)
+calibrated_classifier = None
+# Numbers the recording folders of successive sessions
+session_numbers = itertools.count()
+
+# Define a function to get (or create) the session of a simulator
+def get_session(sid):
+    if sid not in sessions:
+        sessions[sid] = RoverSession(sid)
+    return sessions[sid]
+
+# Per-stage latency of the telemetry handler (across all rovers)
+timer = StageTimer()
+# Time of the last stats file dump
+stats_dumped = time.time()
+
+# Define a function to run decode, perception, decision and inset image
+# encoding for one telemetry message.  This may run on a worker thread, so it
+# only touches the session's own state and returns the reply for the handler
+# to send: ('pickup',), ('control', commands, image1, image2) or ('invalid',)
+def process_telemetry(session, data):
+    # Profile the frame (--profile_frames) in the thread that processes it
+    with timer.profile():
+        return process_frame(session, data)
+
+# Define a function to do the work of process_telemetry() for one frame
+def process_frame(session, data):
+    Rover = session.Rover
+    # Initialize / update Rover with current telemetry
+    with timer.stage('decode'):
+        Rover = update_rover(Rover, data, session.decoder)
+    # Keep the reported throttle, brake and steering for the recording, as
+    # decision_step replaces them with the new commands
+    session.telemetry = (Rover.throttle, convert_to_float(data.get('brake', '0')), Rover.steer)
+
+    # In case of invalid telemetry, send null commands
+    if not np.isfinite(Rover.vel):
+        return ('invalid',)
+
+    # Execute the perception and decision steps to update the Rover's state
+    with timer.stage('perception'):
+        Rover = perception_step(Rover)
+    if Rover.planner is not None:
+        with timer.stage('planning'):
+            Rover.planner.update(Rover)
+    with timer.stage('decision'):
+        Rover = decision_step(Rover)
+
+    # Get the latest output images to send to server (these are
+    # encoded off the control path at a limited rate)
+    with timer.stage('output_images'):
+        out_image_string1, out_image_string2 = session.hud.images(Rover)
+
+    # Don't send both of these, they both trigger the simulator
+    # to send back new telemetry so we must only send one
+    # back in respose to the current telemetry data.
+
+    # If in a state where want to pickup a rock send pickup command
+    if Rover.send_pickup and not Rover.picking_up:
+        # Reset Rover flags
+        Rover.send_pickup = False
+        return ('pickup',)
+    commands = (Rover.throttle, Rover.brake, Rover.steer)
+    return ('control', commands, out_image_string1, out_image_string2)
+
+# Define a function to process one telemetry frame and send the reply.
+# A session whose simulator disconnects while a frame is being processed is
+# only closed once the frame is done, and frames arriving after that are
+# ignored, so the recorder and publisher never see a frame after closing.
+def handle_frame(session, data):
+    if session.closing:
+        return
+    session.frames_in_flight += 1
+    try:
+        process_and_reply(session, data)
+    finally:
+        session.frames_in_flight -= 1
+        if session.closing and session.frames_in_flight == 0:
+            session.close()
 
-# Variables to track frames per second (FPS)
-# Intitialize frame counter
-frame_counter = 0
-# Initalize second counter
-second_counter = time.time()
-fps = None
+# Define a function to process one telemetry frame, send the reply and
+# record or publish the frame
+def process_and_reply(session, data):
+    frame_start = time.perf_counter()
+    sid = session.sid
+    # Hand the work to the worker pool (if enabled) so other
+    # simulators can be served while this frame is processed
+    if args.workers > 0:
+        reply = tpool.execute(process_telemetry, session, data)
+    else:
+        reply = process_telemetry(session, data)
+
+    # The action step!  Send commands to the rover!
+    if reply[0] == 'pickup':
+        commands = None
+        with timer.stage('send_pickup'):
+            send_pickup(sid)
+    elif reply[0] == 'control':
+        # Send commands to the rover!
+        commands = reply[1]
+        session.last_commands = commands
+        with timer.stage('send_control'):
+            send_control(reply[1], reply[2], reply[3], sid)
+    else:
+        # Send zeros for throttle, brake and steer and empty images
+        commands = (0, 0, 0)
+        send_control(commands, '', '', sid)
+
+    # If you want to record the run from autonomous driving specify a path
+    # Example: $ python drive_rover.py recording_folder_path
+    # The frame, telemetry and reply are written by a background thread
+    if session.recorder is not None or session.publisher is not None:
+        record = make_record(session.Rover, session.telemetry, commands)
+        if session.recorder is not None:
+            session.recorder.append(session.Rover.img, record)
+        # Latest state for readers in other processes (shared_state.py)
+        if session.publisher is not None:
+            with timer.stage('publish'):
+                session.publisher.publish(session.Rover, record)
+
+    timer.record('frame', time.perf_counter() - frame_start)
 
+# Define a function to process only the newest frame of a simulator.
+# Frames that arrive while another frame is being processed are coalesced:
+# only the newest one is kept, and each frame it replaces is dropped and
+# answered straight away with the last command (and inset images) sent.
+def handle_latest_frame(session, data):
+    if session.busy:
+        # Swap in the new frame before replying, as sending yields
+        # to other handlers
+        dropped, session.pending = session.pending, data
+        if dropped is not None:
+            session.dropped += 1
+            send_control(session.last_commands, session.hud.latest[0],
+                         session.hud.latest[1], session.sid)
+        return
+    session.busy = True
+    try:
+        while data is not None:
+            handle_frame(session, data)
+            data, session.pending = session.pending, None
+    finally:
+        session.busy = False
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
 def telemetry(sid, data):
-
-    global frame_counter, second_counter, fps
-    frame_counter+=1
-    # Do a rough calculation of frames per second (FPS)
-    if (time.time() - second_counter) > 1:
-        fps = frame_counter
-        frame_counter = 0
-        second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+    global stats_dumped
+    session = get_session(sid)
+    session.count_frame()
+    if args.stats_file != '' and (time.time() - stats_dumped) > 1:
+        timer.dump(args.stats_file)
+        stats_dumped = time.time()
 
     if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
-
-        if np.isfinite(Rover.vel):
-
-            # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
-            Rover = decision_step(Rover)
-
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
-
-            # The action step!  Send commands to the rover!
- 
-            # Don't send both of these, they both trigger the simulator
-            # to send back new telemetry so we must only send one
-            # back in respose to the current telemetry data.
-
-            # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
-                # Reset Rover flags
-                Rover.send_pickup = False
-            else:
-                # Send commands to the rover!
-                commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
-
-        # In case of invalid telemetry, send null commands
+        if args.latest_frame:
+            handle_latest_frame(session, data)
         else:
-
-            # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
-
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+            with session.lock:
+                handle_frame(session, data)
 
     else:
-        sio.emit('manual', data={}, skip_sid=True)
+        sio.emit('manual', data={}, room=sid)
 
 @sio.on('connect')
 def connect(sid, environ):
     print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    get_session(sid)
+    send_control((0, 0, 0), '', '', sid)
     sample_data = {}
     sio.emit(
         "get_samples",
         sample_data,
-        skip_sid=True)
+        room=sid)
+
+@sio.on('disconnect')
+def disconnect(sid):
+    print("disconnect ", sid)
+    session = sessions.pop(sid, None)
+    if session is not None:
+        session.closing = True
+        if session.frames_in_flight == 0:
+            session.close()
 
-def send_control(commands, image_string1, image_string2):
+# Make sure recordings are flushed and shared memory is released on exit
+@atexit.register
+def close_sessions():
+    for session in sessions.values():
+        session.close(block=True)
+
+# Define a function to send commands to one simulator (or to all of them
+# if no sid is given)
+def send_control(commands, image_string1, image_string2, sid=None):
     # Define commands to be sent to the rover
     data={
         'throttle': commands[0].__str__(),
@@ -171,16 +395,16 @@ def send_control(commands, image_string1, image_string2):
     sio.emit(
         "data",
         data,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 # Define a function to send the "pickup" command 
-def send_pickup():
+def send_pickup(sid=None):
     print("Picking up")
     pickup = {}
     sio.emit(
         "pickup",
         pickup,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
@@ -189,13 +413,113 @@ if __name__ == '__main__':
         type=str,
         nargs='?',
         default='',
-        help='Path to image folder. This is where the images from the run will be saved.'
+        help='Path to recording folder. This is where the camera frames, telemetry '
+             'and commands of the run will be saved (one rover_N folder per simulator).'
+    )
+    parser.add_argument(
+        '--hud_rate',
+        type=float,
+        default=5,
+        help='Maximum update rate (Hz) of the inset images. 0 encodes them inline every frame.'
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='Print the decoded telemetry status on every frame.'
+    )
+    parser.add_argument(
+        '--decode_timing',
+        action='store_true',
+        help='Record and print the mean decode time of each telemetry field.'
+    )
+    parser.add_argument(
+        '--stats_file',
+        type=str,
+        default='',
+        help='Write per-stage latency percentiles to this JSON file once a second.'
+    )
+    parser.add_argument(
+        '--stats_port',
+        type=int,
+        default=0,
+        help='Serve per-stage latency percentiles as JSON on this local port.'
+    )
+    parser.add_argument(
+        '--profile_frames',
+        type=int,
+        default=0,
+        help='Capture a cProfile of the first N frames.'
+    )
+    parser.add_argument(
+        '--profile_file',
+        type=str,
+        default='drive_rover.prof',
+        help='Where to save the cProfile capture.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='Run perception and decision on a pool of N worker threads, '
+             'so several simulators can be driven at once. 0 runs them in the handler.'
+    )
+    parser.add_argument(
+        '--latest_frame',
+        action='store_true',
+        help='Only process the newest frame of each simulator and answer frames '
+             'that arrive in the meantime with the last command. Frames can only '
+             'queue up while processing yields, i.e. with --workers.'
+    )
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        help='Plan paths to unexplored frontiers on the worldmap and steer towards them.'
+    )
+    parser.add_argument(
+        '--perception_mode',
+        type=str,
+        default='full',
+        choices=sorted(perception_modes),
+        help='Perception footprint: full, roi (camera rows up to 10 m straight ahead), range '
+             '(pixels within 10 m), half/quarter (2x/4x downsampled) or fast (range + half).'
+    )
+    parser.add_argument(
+        '--max_tilt',
+        type=float,
+        default=1.,
+        help="Don't map frames with pitch or roll beyond this many degrees (they still "
+             'steer), and skip perception on frames from an unchanged pose. 0 integrates every frame.'
+    )
+    parser.add_argument(
+        '--rock_calibration',
+        type=str,
+        default='',
+        help='Glob pattern of example rock images (e.g. ../calibration_images/example_rock*.jpg) '
+             'to fit the rock color rule to, instead of the default thresholds.'
+    )
+    parser.add_argument(
+        '--shared_memory',
+        type=str,
+        default='',
+        help='Publish the worldmap, vision image and latest telemetry of each simulator '
+             'in a shared memory block named <name>_N (read with shared_state.py).'
     )
     args = parser.parse_args()
+    if args.rock_calibration != '':
+        rules = load_calibrated_rules(args.rock_calibration)
+        print("Fitted rock rule: {}".format(rules[-1]))
+        calibrated_classifier = ColorClassifier(rules)
+    if args.workers > 0:
+        tpool.set_num_threads(args.workers)
+    if args.stats_port > 0:
+        timer.serve(args.stats_port)
+        print("Serving stage latencies at http://127.0.0.1:{}/".format(args.stats_port))
+    if args.profile_frames > 0:
+        timer.start_profile(args.profile_frames, args.profile_file)
     
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
-        print("Creating image folder at {}".format(args.image_folder))
+        print("Creating recording folder at {}".format(args.image_folder))
         if not os.path.exists(args.image_folder):
             os.makedirs(args.image_folder)
         else:
@@ -0,0 +1,49 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from supporting_functions import create_output_images, render_output_images, encode_image
+
+# Define a function to encode both inset images (runs on the worker thread)
+def encode_output_images(map_img, vision_img):
+    return encode_image(map_img), encode_image(vision_img)
+
+# Define a class that keeps the inset image encoding off the control path.
+# The display images are rendered at most `rate` times per second, and only
+# when the worldmap or vision image has changed since the last render.  JPEG/base64 encoding
+# happens on a worker thread, and in the meantime the last encoded images
+# are reused, so the control commands never wait on the display output.
+# A rate of 0 encodes inline on every frame (the original behaviour).
+class HudEncoder():
+    def __init__(self, rate=5):
+        self.rate = rate # Maximum inset image update rate (Hz)
+        self.latest = ('', '') # Most recently encoded inset images
+        self.last_render = 0 # Time of the last render
+        self.last_version = None # Worldmap and vision image versions of the last render
+        self.pending = None # Encoding job in flight
+        self.executor = None
+        if rate > 0:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+    # Return the current pair of encoded inset images for this Rover
+    def images(self, Rover):
+        if self.executor is None:
+            self.latest = create_output_images(Rover)
+            return self.latest
+        # Pick up the result of a finished encoding job
+        if self.pending is not None and self.pending.done():
+            self.latest = self.pending.result()
+            self.pending = None
+        now = time.time()
+        version = (Rover.map_stats.version, Rover.vision_version)
+        if self.pending is None and (now - self.last_render) >= 1.0 / self.rate \
+                and version != self.last_version:
+            self.last_render = now
+            self.last_version = version
+            map_img, vision_img = render_output_images(Rover)
+            self.pending = self.executor.submit(encode_output_images, map_img, vision_img)
+        return self.latest
+
+    # Stop the encoding thread (a job in flight is left to finish)
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
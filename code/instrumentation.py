@@ -0,0 +1,109 @@
+import cProfile
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import numpy as np
+
+# Define a class to time the stages of the drive loop.  The most recent
+# `window` samples of each stage are kept so that rolling percentiles can be
+# reported, dumped to a JSON file or served over a local HTTP endpoint.
+# A cProfile capture of the next N frames can also be requested.
+class StageTimer():
+    def __init__(self, window=1000):
+        self.window = window # Number of samples kept per stage
+        self.samples = OrderedDict() # Stage name -> recent durations (seconds)
+        self.lock = threading.Lock() # The HTTP endpoint reads from another thread
+        self.profiler = None # Active cProfile capture
+        self.profile_lock = threading.Lock() # Held while a frame is profiled
+        self.profile_frames = 0 # Frames left to capture
+        self.profile_path = None # Where to write the capture
+        self.server = None
+
+    # Context manager timing one stage, e.g. "with timer.stage('decode'):"
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def record(self, name, seconds):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(seconds)
+
+    # Return count, mean and p50/p95/p99/max latency (ms) of each stage
+    def summary(self):
+        with self.lock:
+            snapshot = [(name, np.array(values)) for name, values in self.samples.items()]
+        summary = OrderedDict()
+        for name, values in snapshot:
+            if len(values) == 0:
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+            summary[name] = {'count': len(values),
+                             'mean_ms': round(float(values.mean()) * 1000, 3),
+                             'p50_ms': round(float(p50), 3),
+                             'p95_ms': round(float(p95), 3),
+                             'p99_ms': round(float(p99), 3),
+                             'max_ms': round(float(values.max()) * 1000, 3)}
+        return summary
+
+    # Write the summary to a JSON file
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    # Serve the summary as JSON on http://host:port/ from a daemon thread
+    def serve(self, port, host='127.0.0.1'):
+        timer = self
+        class SummaryHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(timer.summary(), indent=2).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        self.server = HTTPServer((host, port), SummaryHandler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self.server
+
+    # Start a cProfile capture covering the next `frames` profiled frames
+    def start_profile(self, frames, path):
+        self.profiler = cProfile.Profile()
+        self.profile_frames = frames
+        self.profile_path = path
+
+    # Context manager profiling the work of one frame, e.g.
+    # "with timer.profile():".  cProfile only sees the thread that enables
+    # it, so the capture is enabled around the frame's work in whichever
+    # thread runs it.  One frame is profiled at a time; frames processed
+    # concurrently in other threads meanwhile run unprofiled.
+    @contextmanager
+    def profile(self):
+        profiler = self.profiler
+        if profiler is None or not self.profile_lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+            self.profile_frames -= 1
+            if self.profile_frames <= 0 and self.profiler is profiler:
+                profiler.dump_stats(self.profile_path)
+                print("Saved profile to {}".format(self.profile_path))
+                self.profiler = None
+        finally:
+            self.profile_lock.release()
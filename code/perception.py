@@ -1,30 +1,49 @@
+import threading
 import numpy as np
 import cv2
+from collections import namedtuple
+from worldmap import add_evidence, cell_index, map_resolution, world_meters
+from classifier import ColorClassifier
 
 # Identify pixels above the threshold
 # Threshold of RGB > 160 does a nice job of identifying ground pixels only
 def color_thresh(img, rgb_thresh=(160, 160, 160)):
-    # Create an array of zeros same xy size as img, but single channel
-    color_select = np.zeros_like(img[:,:,0])
     # Require that each pixel be above all three threshold values in RGB
     # above_thresh will now contain a boolean array with "True"
     # where threshold was met
     above_thresh = (img[:,:,0] > rgb_thresh[0]) \
                 & (img[:,:,1] > rgb_thresh[1]) \
                 & (img[:,:,2] > rgb_thresh[2])
-    # Index the array of zeros with the boolean array and set to 1
-    color_select[above_thresh] = 1
-    # Return the binary image
-    return color_select
+    # Return the binary image (same xy size as img, but single channel)
+    return above_thresh.astype(img.dtype)
+
+# Define a function to classify an (..., 3) array of gathered RGB pixels,
+# returning boolean navigable, obstacle and rock sample masks
+# Rock samples are yellow: high red and green, low blue
+def classify_pixels(pixels, rgb_thresh=(160, 160, 160),
+                    rock_low=(110, 110, 0), rock_high=(255, 255, 50)):
+    red, green, blue = pixels[...,0], pixels[...,1], pixels[...,2]
+    navigable = (red > rgb_thresh[0]) & (green > rgb_thresh[1]) & (blue > rgb_thresh[2])
+    rock = (red > rock_low[0]) & (red < rock_high[0]) \
+         & (green > rock_low[1]) & (green < rock_high[1]) \
+         & (blue > rock_low[2]) & (blue < rock_high[2])
+    # Everything inside the camera footprint that isn't navigable is an obstacle
+    obstacle = ~navigable
+    return navigable, obstacle, rock
 
 # Define a function to convert from image coords to rover coords
 def rover_coords(binary_img):
     # Identify nonzero pixels
     ypos, xpos = binary_img.nonzero()
+    return pixel_rover_coords(ypos, xpos, binary_img.shape)
+
+# Define a function to convert (row, column) pixel positions of an image
+# with the given shape to rover coords
+def pixel_rover_coords(ypos, xpos, shape):
     # Calculate pixel positions with reference to the rover position being at the 
     # center bottom of the image.  
-    x_pixel = -(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[1]/2 ).astype(np.float)
+    x_pixel = -(ypos - shape[0]).astype(np.float64)
+    y_pixel = -(xpos - shape[1]/2 ).astype(np.float64)
     return x_pixel, y_pixel
 
 
@@ -42,9 +61,11 @@ def to_polar_coords(x_pixel, y_pixel):
 def rotate_pix(xpix, ypix, yaw):
     # Convert yaw to radians
     yaw_rad = yaw * np.pi / 180
-    xpix_rotated = (xpix * np.cos(yaw_rad)) - (ypix * np.sin(yaw_rad))
+    cos_yaw = np.cos(yaw_rad)
+    sin_yaw = np.sin(yaw_rad)
+    xpix_rotated = (xpix * cos_yaw) - (ypix * sin_yaw)
                             
-    ypix_rotated = (xpix * np.sin(yaw_rad)) + (ypix * np.cos(yaw_rad))
+    ypix_rotated = (xpix * sin_yaw) + (ypix * cos_yaw)
     # Return the result  
     return xpix_rotated, ypix_rotated
 
@@ -69,41 +90,421 @@ def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
     # Return the result
     return x_pix_world, y_pix_world
 
+# Cache of perspective matrices keyed on the calibration points, so the
+# matrix is only solved once for any given src/dst pair
+perspective_matrices = {}
+
+# Define a function to look up (or solve once) the perspective matrix
+def get_perspective_matrix(src, dst):
+    key = (np.float32(src).tobytes(), np.float32(dst).tobytes())
+    if key not in perspective_matrices:
+        perspective_matrices[key] = cv2.getPerspectiveTransform(np.float32(src), np.float32(dst))
+    return perspective_matrices[key]
+
 # Define a function to perform a perspective transform
 def perspect_transform(img, src, dst):
            
-    M = cv2.getPerspectiveTransform(src, dst)
+    M = get_perspective_matrix(src, dst)
     warped = cv2.warpPerspective(img, M, (img.shape[1], img.shape[0]))# keep same size as input image
     
     return warped
 
+# Define a class that precomputes a perspective transform as a sparse pixel
+# index.  Every destination (top-down) pixel is mapped back into the camera
+# image once at startup; pixels that land outside the camera view are dropped.
+# Each frame then only needs a single gather of the source pixels that fall
+# inside the top-down footprint instead of a matrix solve and full-image warp.
+# The footprint can be reduced to trade map fidelity for speed: min_row crops
+# the camera image to rows from min_row down (a region of interest), max_dist
+# drops pixels further than max_dist (warped image pixels) from the rover and
+# step keeps only every step-th row and column of the warped image.
+class WarpTable():
+    def __init__(self, src, dst, shape=(160, 320), min_row=0, max_dist=None, step=1):
+        self.shape = shape
+        self.M = get_perspective_matrix(src, dst)
+        rows, cols = shape
+        ygrid, xgrid = np.mgrid[0:rows, 0:cols]
+        ygrid, xgrid = ygrid.ravel(), xgrid.ravel()
+        # Map every destination pixel back to the camera image (nearest neighbour)
+        dst_pts = np.vstack((xgrid, ygrid, np.ones_like(xgrid))).astype(np.float64)
+        Minv = np.linalg.inv(self.M)
+        src_pts = Minv.dot(dst_pts)
+        # Points behind the camera have the opposite homogeneous sign
+        # to the calibration points and must be discarded
+        facing = np.sign(Minv.dot([dst[0][0], dst[0][1], 1])[2])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            src_x = np.round(src_pts[0] / src_pts[2])
+            src_y = np.round(src_pts[1] / src_pts[2])
+        inside = (src_pts[2] * facing > 0) & (src_x >= 0) & (src_x < cols) \
+                & (src_y >= min_row) & (src_y < rows)
+        if max_dist is not None:
+            grid_x, grid_y = pixel_rover_coords(ygrid, xgrid, shape)
+            inside &= np.sqrt(grid_x**2 + grid_y**2) <= max_dist
+        if step > 1:
+            inside &= (ygrid % step == 0) & (xgrid % step == 0)
+        # Full resolution pixels represented by each footprint pixel
+        self.weight = step * step
+        # Flat indices into the camera image and into the warped image
+        self.src_index = (src_y[inside] * cols + src_x[inside]).astype(np.intp)
+        self.dst_index = (ygrid[inside] * cols + xgrid[inside]).astype(np.intp)
+        # Row and column of each footprint pixel in the warped image
+        self.ypos = ygrid[inside]
+        self.xpos = xgrid[inside]
+        # Pose independent rover-centric coords and polar coords of every
+        # footprint pixel, computed once
+        xpix, ypix = pixel_rover_coords(self.ypos, self.xpos, shape)
+        self.xpix = xpix.astype(np.float32)
+        self.ypix = ypix.astype(np.float32)
+        dists, angles = to_polar_coords(xpix, ypix)
+        self.dists = dists.astype(np.float32)
+        self.angles = angles.astype(np.float32)
+        # Footprint pixels sorted by angle and by distance, and the angle
+        # histogram bin of every pixel, for nav_summary()
+        self.angle_order = np.argsort(self.angles, kind='stable')
+        self.dist_order = np.argsort(self.dists, kind='stable')
+        self.angle_bin = np.clip(np.digitize(self.angles, nav_angle_edges) - 1,
+                                 0, len(nav_angle_edges) - 2)
+        # Preallocated scratch buffers for to_world(), one set per thread
+        self.scratch = threading.local()
+
+    # Return this thread's to_world() scratch buffers
+    def buffers(self):
+        buffers = getattr(self.scratch, 'buffers', None)
+        if buffers is None:
+            npix = len(self.src_index)
+            buffers = [np.empty(npix, dtype=np.float32) for idx in range(4)] \
+                    + [np.empty(npix, dtype=np.intp) for idx in range(2)]
+            self.scratch.buffers = buffers
+        return buffers
+
+    # Gather the camera pixels inside the footprint as an (N, channels) array
+    def gather(self, img):
+        return img.reshape(-1, img.shape[2])[self.src_index]
+
+    # Gather the footprint pixels of a (frames, rows, cols, channels) stack
+    # as a (frames, N, channels) array.  Indexing rows of the flattened stack
+    # with take() is much faster than fancy indexing the middle axis.
+    def gather_stack(self, imgs):
+        frame_offsets = np.arange(len(imgs))[:, None] * (imgs.shape[1] * imgs.shape[2])
+        return imgs.reshape(-1, imgs.shape[-1]).take(frame_offsets + self.src_index, axis=0)
+
+    # Produce the full warped image (equivalent to perspect_transform)
+    def warp(self, img):
+        warped = np.zeros_like(img)
+        warped.reshape(-1, img.shape[2])[self.dst_index] = self.gather(img)
+        return warped
+
+    # Fused rover-to-world transform for the footprint pixels selected by
+    # the boolean mask (as returned by classify_pixels).  Rotation, scaling,
+    # translation and clipping are done in place in the preallocated float32
+    # buffers with the trig evaluated once.  The returned world indices are
+    # views into this thread's buffers and are only valid until its next call.
+    # If polar is True, the rover-centric distances and angles of the
+    # selected pixels are also returned (as new arrays).
+    def to_world(self, mask, xpos, ypos, yaw, world_size, scale, polar=False):
+        npix = np.count_nonzero(mask)
+        x_buf, y_buf, x_rot_buf, y_rot_buf, x_world_buf, y_world_buf = self.buffers()
+        xpix = np.compress(mask, self.xpix, out=x_buf[:npix])
+        ypix = np.compress(mask, self.ypix, out=y_buf[:npix])
+        x_rot = x_rot_buf[:npix]
+        y_rot = y_rot_buf[:npix]
+        yaw_rad = yaw * np.pi / 180
+        cos_s = np.float32(np.cos(yaw_rad) / scale)
+        sin_s = np.float32(np.sin(yaw_rad) / scale)
+        # x_world = (xpix * cos - ypix * sin) / scale + xpos
+        # y_world = (xpix * sin + ypix * cos) / scale + ypos
+        np.multiply(xpix, cos_s, out=x_rot)
+        np.multiply(xpix, sin_s, out=y_rot)
+        # xpix is no longer needed, reuse its buffer for ypix * sin
+        np.multiply(ypix, sin_s, out=xpix)
+        x_rot -= xpix
+        ypix *= cos_s
+        y_rot += ypix
+        x_rot += xpos
+        y_rot += ypos
+        np.clip(x_rot, 0, world_size - 1, out=x_rot)
+        np.clip(y_rot, 0, world_size - 1, out=y_rot)
+        x_world = x_world_buf[:npix]
+        y_world = y_world_buf[:npix]
+        np.copyto(x_world, x_rot, casting='unsafe')
+        np.copyto(y_world, y_rot, casting='unsafe')
+        if polar:
+            return x_world, y_world, self.dists[mask], self.angles[mask]
+        return x_world, y_world
+
+    # Summarize the navigable terrain selected by the boolean mask
+    def nav_summary(self, mask):
+        return NavSummary(self, mask)
+
+# Define a function returning percentiles (linearly interpolated, like
+# np.percentile) of the values selected by mask, given the order that
+# sorts all the values.  No per-frame sort is needed.
+def masked_percentiles(values, order, mask, percentiles):
+    ranks = np.flatnonzero(mask[order])
+    position = np.asarray(percentiles, dtype=np.float64) / 100 * (len(ranks) - 1)
+    low = np.floor(position).astype(np.intp)
+    high = np.ceil(position).astype(np.intp)
+    low_values = values[order[ranks[low]]].astype(np.float64)
+    high_values = values[order[ranks[high]]].astype(np.float64)
+    return low_values + (high_values - low_values) * (position - low)
+
+# Define a class holding a compact summary of the navigable terrain in one
+# frame.  Decisions only need these few numbers and the fixed size angle
+# histogram instead of the per-pixel angle and distance arrays.
+# Pixel counts are at full resolution, whatever the step of the table.
+class NavSummary():
+    def __init__(self, table, mask):
+        self.count = int(np.count_nonzero(mask)) * table.weight # Number of navigable pixels
+        # Navigable pixels per angle bin (bin edges in nav_angle_edges)
+        self.angle_hist = np.bincount(table.angle_bin[mask],
+                                      minlength=len(nav_angle_edges) - 1) * table.weight
+        self.mean_angle = 0. # Mean angle (radians)
+        self.median_angle = 0. # Median angle (radians)
+        self.mean_dist = 0. # Mean distance (pixels)
+        # Distance percentiles (pixels) at nav_dist_percentiles
+        self.dist_percentiles = np.zeros(len(nav_dist_percentiles))
+        if self.count:
+            npix = self.count / table.weight
+            self.mean_angle = float(np.sum(table.angles, where=mask, dtype=np.float64)) / npix
+            self.mean_dist = float(np.sum(table.dists, where=mask, dtype=np.float64)) / npix
+            self.median_angle = float(masked_percentiles(table.angles, table.angle_order,
+                                                         mask, [50])[0])
+            self.dist_percentiles = masked_percentiles(table.dists, table.dist_order,
+                                                       mask, nav_dist_percentiles)
+
+# Define calibration box in source (actual) and destination (desired) coordinates
+# These source and destination points are defined to warp the image
+# to a grid where each 10x10 pixel square represents 1 square meter
+# The destination box will be 2*dst_size on each side
+dst_size = 5
+# Set a bottom offset to account for the fact that the bottom of the image
+# is not the position of the rover but a bit in front of it
+bottom_offset = 6
+source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+destination = np.float32([[160 - dst_size, 160 - bottom_offset],
+                  [160 + dst_size, 160 - bottom_offset],
+                  [160 + dst_size, 160 - 2*dst_size - bottom_offset],
+                  [160 - dst_size, 160 - 2*dst_size - bottom_offset],
+                  ])
+# Number of warped image pixels per worldmap pixel (1 meter)
+world_scale = 2 * dst_size
+# Angle histogram bin edges (5 degree bins covering the camera footprint)
+# and distance percentiles of the navigable terrain summary
+nav_angle_edges = np.radians(np.arange(-55, 56, 5))
+nav_dist_percentiles = (10, 50, 90)
+# Perception modes, as WarpTable footprint options.  'roi' crops the camera
+# image to the rows below the one seeing 10 m straight ahead (row 81, the
+# footprint still reaches further out towards its sides), 'range' drops
+# warped pixels beyond 10 m (100 pixels), 'half' and 'quarter' downsample the warped image 2x and
+# 4x, and 'fast' combines the range limit with 2x downsampling.
+perception_modes = {
+    'full': {},
+    'roi': {'min_row': 81},
+    'range': {'max_dist': 100},
+    'half': {'step': 2},
+    'quarter': {'step': 4},
+    'fast': {'max_dist': 100, 'step': 2},
+}
+# Warp lookup tables, by perception mode
+warp_tables = {}
+
+# Define a function to return the (cached) warp table of a perception mode
+def get_warp_table(mode='full'):
+    if mode not in warp_tables:
+        warp_tables[mode] = WarpTable(source, destination, **perception_modes[mode])
+    return warp_tables[mode]
+
+# Build the default warp lookup table once at startup
+warp_table = get_warp_table('full')
+# Worldmap evidence added per frame for obstacle, rock and navigable cells
+evidence_amounts = (1, 1, 10)
+# Color lookup table classifier used unless the Rover has its own (the
+# default rules match classify_pixels)
+color_classifier = ColorClassifier()
+
+# Define a function to add evidence to one channel of the worldmap.  If the
+# Rover tracks incremental map statistics they are updated at the same time.
+def update_worldmap(Rover, channel, x_world, y_world, amount):
+    if Rover.map_stats is not None:
+        Rover.map_stats.update(Rover.worldmap, channel, x_world, y_world, amount)
+    else:
+        add_evidence(Rover.worldmap, channel, cell_index(Rover.worldmap, x_world, y_world), amount)
+
+# Define a class that decides which frames are worth integrating into the
+# worldmap.  The perspective transform assumes a level camera, so frames
+# with pitch or roll beyond max_tilt degrees are not mapped, though they are
+# still classified so decisions always see the current navigable terrain.
+# Frames taken from the same pose as the last integrated frame are skipped
+# entirely (the camera sees the same scene while the rover stands still) and
+# keep the last vision image and navigable terrain summary.
+class PoseGate():
+    def __init__(self, max_tilt=1., min_move=0.05, min_turn=0.5):
+        self.max_tilt = max_tilt # Degrees of pitch or roll
+        self.min_move = min_move # Meters moved since the last integrated frame
+        self.min_turn = min_turn # Degrees turned since the last integrated frame
+        self.last_pose = None # (x, y, yaw) of the last integrated frame
+        self.skipped = {'tilted': 0, 'unchanged': 0} # Skipped frames by reason
+        self.integrated = 0 # Integrated frames
+
+    # Return why the Rover's current frame should be skipped, or None
+    def check(self, Rover):
+        if angle_diff(Rover.pitch, 0) > self.max_tilt or angle_diff(Rover.roll, 0) > self.max_tilt:
+            reason = 'tilted'
+        elif self.last_pose is not None \
+                and np.hypot(Rover.pos[0] - self.last_pose[0], Rover.pos[1] - self.last_pose[1]) < self.min_move \
+                and angle_diff(Rover.yaw, self.last_pose[2]) < self.min_turn:
+            reason = 'unchanged'
+        else:
+            self.last_pose = (Rover.pos[0], Rover.pos[1], Rover.yaw)
+            self.integrated += 1
+            return None
+        self.skipped[reason] += 1
+        return reason
+
+# Define a function to return the absolute difference of two angles in degrees
+def angle_diff(a, b):
+    return abs((a - b + 180) % 360 - 180)
 
 # Apply the above functions in succession and update the Rover state accordingly
 def perception_step(Rover):
     # Perform perception steps to update Rover()
-    # TODO: 
     # NOTE: camera image is coming to you in Rover.img
-    # 1) Define source and destination points for perspective transform
-    # 2) Apply perspective transform
-    # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
+    # 0) Skip repeated frames, keeping the last results, and don't map
+    # tilted ones
+    skip = Rover.pose_gate.check(Rover) if Rover.pose_gate is not None else None
+    if skip == 'unchanged':
+        return Rover
+    # 1) and 2) Gather only the camera pixels inside the precomputed
+    # perspective transform footprint of the Rover's perception mode
+    table = get_warp_table(Rover.perception_mode)
+    pixels = table.gather(Rover.img)
+    # 3) Classify navigable terrain/obstacles/rock samples with a single
+    # color lookup table gather
+    classifier = Rover.classifier if Rover.classifier is not None else color_classifier
+    navigable, obstacle, rock = classifier.classify(pixels)
     # 4) Update Rover.vision_image (this will be displayed on left side of screen)
-        # Example: Rover.vision_image[:,:,0] = obstacle color-thresholded binary image
-        #          Rover.vision_image[:,:,1] = rock_sample color-thresholded binary image
-        #          Rover.vision_image[:,:,2] = navigable terrain color-thresholded binary image
-
-    # 5) Convert map image pixel values to rover-centric coords
-    # 6) Convert rover-centric pixel values to world coordinates
-    # 7) Update Rover worldmap (to be displayed on right side of screen)
-        # Example: Rover.worldmap[obstacle_y_world, obstacle_x_world, 0] += 1
-        #          Rover.worldmap[rock_y_world, rock_x_world, 1] += 1
-        #          Rover.worldmap[navigable_y_world, navigable_x_world, 2] += 1
-
-    # 8) Convert rover-centric pixel positions to polar coordinates
-    # Update Rover pixel distances and angles
-        # Rover.nav_dists = rover_centric_pixel_distances
-        # Rover.nav_angles = rover_centric_angles
-    
- 
-    
-    
-    return Rover
\ No newline at end of file
+    Rover.vision_image[:] = 0
+    vision = Rover.vision_image.reshape(-1, 3)
+    vision[table.dst_index[obstacle], 0] = 255
+    vision[table.dst_index[rock], 1] = 255
+    vision[table.dst_index[navigable], 2] = 255
+    Rover.vision_version += 1
+    if skip == 'tilted':
+        Rover.nav_summary = table.nav_summary(navigable)
+        Rover.nav_angles, Rover.nav_dists = table.angles[navigable], table.dists[navigable]
+        return Rover
+    # 5) and 6) Convert the precomputed rover-centric coords of each class
+    # to world coordinates and 7) update Rover worldmap (to be displayed on
+    # right side of screen) before the transform buffers are reused
+    # The worldmap may have more than one cell per meter
+    world_size = Rover.worldmap.shape[0]
+    resolution = map_resolution(Rover.worldmap)
+    xpos, ypos = Rover.pos[0] * resolution, Rover.pos[1] * resolution
+    scale = world_scale / resolution
+    obstacle_x_world, obstacle_y_world = table.to_world(obstacle,
+                              xpos, ypos, Rover.yaw, world_size, scale)
+    update_worldmap(Rover, 0, obstacle_x_world, obstacle_y_world, evidence_amounts[0])
+    rock_x_world, rock_y_world = table.to_world(rock,
+                              xpos, ypos, Rover.yaw, world_size, scale)
+    update_worldmap(Rover, 1, rock_x_world, rock_y_world, evidence_amounts[1])
+    # 8) Rover-centric polar coordinates of navigable pixels come
+    # straight from the precomputed table
+    navigable_x_world, navigable_y_world, Rover.nav_dists, Rover.nav_angles = \
+            table.to_world(navigable, xpos, ypos, Rover.yaw,
+                           world_size, scale, polar=True)
+    update_worldmap(Rover, 2, navigable_x_world, navigable_y_world, evidence_amounts[2])
+    # 9) Publish the compact navigable terrain summary used by decision_step
+    Rover.nav_summary = table.nav_summary(navigable)
+
+    return Rover
+
+# World pixels of one class from a batch of frames: the frame each pixel
+# came from and its (clipped) worldmap x and y
+WorldPixels = namedtuple('WorldPixels', ['frame', 'x', 'y'])
+
+# Per frame navigable terrain statistics returned by perception_batch()
+nav_stats_dtype = np.dtype([('count', np.int32), # Number of navigable pixels
+                            ('mean_angle', np.float32), # Mean angle (radians)
+                            ('mean_dist', np.float32)]) # Mean distance (pixels)
+
+# Define a function to return the (clipped) worldmap x and y of every
+# footprint pixel of a table for (frames,) pose arrays, as (frames, N) arrays.
+# The footprint is rotated, scaled and translated for all frames at once with
+# broadcasting (same float32 arithmetic as to_world).
+def footprint_world(table, xpos, ypos, yaw, world_size=200):
+    resolution = world_size / world_meters
+    scale = world_scale / resolution
+    yaw_rad = np.asarray(yaw, dtype=np.float64)[:, None] * np.pi / 180
+    cos_s = (np.cos(yaw_rad) / scale).astype(np.float32)
+    sin_s = (np.sin(yaw_rad) / scale).astype(np.float32)
+    xpos = (np.asarray(xpos, dtype=np.float64)[:, None] * resolution).astype(np.float32)
+    ypos = (np.asarray(ypos, dtype=np.float64)[:, None] * resolution).astype(np.float32)
+    x_world = table.xpix * cos_s
+    x_world -= table.ypix * sin_s
+    x_world += xpos
+    y_world = table.xpix * sin_s
+    y_world += table.ypix * cos_s
+    y_world += ypos
+    np.clip(x_world, 0, world_size - 1, out=x_world)
+    np.clip(y_world, 0, world_size - 1, out=y_world)
+    return x_world.astype(np.intp), y_world.astype(np.intp)
+
+# Define a function to run perception on a stack of frames at once.
+# imgs is a (frames, 160, 320, 3) uint8 stack and xpos, ypos and yaw are
+# (frames,) pose arrays.  Returns
+#   masks: (frames, 160, 320, 3) uint8 warped obstacle, rock and navigable
+#          masks (0 or 1, in the channel order of Rover.vision_image), or
+#          None if with_masks is False (for callers that only map)
+#   nav_stats: (frames,) nav_stats_dtype array of navigable terrain stats
+#   world: WorldPixels for the obstacle, rock and navigable classes, with the
+#          pixels of all frames concatenated
+def perception_batch(imgs, xpos, ypos, yaw, world_size=200, table=warp_table,
+                     classifier=color_classifier, with_masks=True):
+    nframes = len(imgs)
+    rows, cols = table.shape
+    # Gather and classify the footprint pixels of every frame
+    navigable, obstacle, rock = classifier.classify(table.gather_stack(imgs))
+    classes = (obstacle, rock, navigable)
+    masks = None
+    if with_masks:
+        masks = np.zeros((nframes, rows * cols, 3), dtype=np.uint8)
+        masks[:, table.dst_index] = np.stack(classes, axis=-1)
+        masks = masks.reshape(nframes, rows, cols, 3)
+    # Navigable terrain polar stats as mask-weighted sums over the table
+    nav_stats = np.zeros(nframes, dtype=nav_stats_dtype)
+    counts = np.count_nonzero(navigable, axis=1)
+    nav_weights = navigable.astype(np.float32)
+    nav_stats['count'] = counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nav_stats['mean_angle'] = nav_weights.dot(table.angles) / counts
+        nav_stats['mean_dist'] = nav_weights.dot(table.dists) / counts
+    # Every footprint pixel is either navigable or an obstacle, so transform
+    # the whole footprint of every frame at once
+    x_world, y_world = footprint_world(table, xpos, ypos, yaw, world_size)
+    frames = np.arange(nframes)
+    world = []
+    for mask in classes:
+        frame = np.repeat(frames, np.count_nonzero(mask, axis=1))
+        world.append(WorldPixels(frame, x_world[mask], y_world[mask]))
+    return masks, nav_stats, world
+
+# Define a function to add the world pixels of a batch to the worldmap.
+# Like perception_step, each frame adds evidence at most once per cell.
+def update_worldmap_batch(worldmap, world, amounts=evidence_amounts):
+    ncells = worldmap.shape[0] * worldmap.shape[1]
+    for channel, (pixels, amount) in enumerate(zip(world, amounts)):
+        # Unique cells of each frame (pixels are grouped by frame), then
+        # the number of frames that hit each cell
+        bounds = np.flatnonzero(np.diff(pixels.frame)) + 1
+        cells = [cell_index(worldmap, x_world, y_world) for x_world, y_world
+                 in zip(np.split(pixels.x, bounds), np.split(pixels.y, bounds))]
+        hits = np.bincount(np.concatenate(cells), minlength=ncells)
+        added = hits.reshape(worldmap.shape[:2]) * amount
+        if np.issubdtype(worldmap.dtype, np.integer):
+            # Saturate instead of wrapping around
+            evidence = worldmap[:,:,channel] + added
+            np.clip(evidence, 0, np.iinfo(worldmap.dtype).max, out=evidence)
+            worldmap[:,:,channel] = evidence
+        else:
+            worldmap[:,:,channel] += added
+    return worldmap
@@ -0,0 +1,214 @@
+import heapq
+import math
+import time
+import numpy as np
+from worldmap import world_meters
+
+# Occupancy state of a planner grid cell
+UNKNOWN, FREE, BLOCKED = 0, 1, 2
+# Cost per meter of moving through a cell in each state.  Unknown cells are
+# cheap enough that paths can cut across unexplored ground, and obstacles
+# are expensive rather than impassable since the mapped obstacles are noisy.
+cell_costs = (2., 1., 50.)
+inf = float('inf')
+
+# Define a class that plans paths to the nearest exploration frontier over an
+# occupancy grid derived from the worldmap.  The grid has one cell per meter:
+# free where navigable evidence outweighs obstacle evidence, blocked where
+# obstacles do, unknown where nothing was seen.  Frontiers are free cells
+# next to unknown ones that the rover hasn't been near yet.
+#
+# Costs to the frontiers are maintained with D* Lite, searching backwards
+# from all frontier cells at once.  Each frame only the cells whose state or
+# frontier status changed are updated, and the search is repaired just far
+# enough to make the rover's cell consistent again, with at most
+# max_expansions cell expansions per frame (any left over carry on next frame).
+# The search runs on the grid padded with a border of impassable cells, so
+# the neighbours of a cell are just fixed offsets of its flat index.
+class Planner():
+    def __init__(self, grid_size=200, evidence_amounts=(1, 1, 10), lookahead=6,
+                 visit_radius=3, max_expansions=500):
+        self.size = grid_size
+        self.evidence_amounts = evidence_amounts # Worldmap evidence added per frame
+        self.lookahead = lookahead # Path steps from the rover to the waypoint
+        self.visit_radius = visit_radius # Cells around the rover that stop being frontiers
+        self.max_expansions = max_expansions
+        self.state = np.zeros(grid_size * grid_size, dtype=np.int8) # Occupancy state of each cell
+        self.frontier = np.zeros(grid_size * grid_size, dtype=bool) # Frontier (goal) cells
+        self.visited = np.zeros((grid_size, grid_size), dtype=bool) # Cells the rover has been near
+        # Padded grid layout: flat index of every grid cell, the neighbour
+        # offsets with half their step lengths and which cells are inside
+        width = grid_size + 2
+        self.width = width
+        ygrid, xgrid = np.mgrid[0:grid_size, 0:grid_size]
+        self.padded = ((ygrid + 1) * width + xgrid + 1).ravel()
+        self.offsets = [(dy * width + dx, math.hypot(dy, dx) / 2)
+                        for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx]
+        inside = np.zeros((width, width), dtype=bool)
+        inside[1:-1, 1:-1] = True
+        self.inside = inside.ravel().tolist()
+        # Row and column of each padded cell, for the heuristic
+        self.rows = np.repeat(np.arange(width), width).tolist()
+        self.cols = np.tile(np.arange(width), width).tolist()
+        # D* Lite state (on the padded grid), as lists since it is read and
+        # written cell by cell
+        self.goals = set() # Frontier cells
+        self.cost = np.where(inside, cell_costs[UNKNOWN], inf).ravel().tolist() # Cost per meter
+        self.g = [inf] * (width * width) # Cost to the nearest frontier
+        self.rhs = [inf] * (width * width) # One step lookahead of g
+        self.queue = [] # Heap of (key, cell), stale entries are skipped
+        self.queued = {} # Cell -> key of its current queue entry
+        self.km = 0. # Key modifier accumulated as the rover moves
+        self.start = None # Rover cell
+        self.path = [] # Cells from the rover to the waypoint
+        self.waypoint = None # (x, y) waypoint in meters
+        self.plan_time = 0. # Seconds spent in the last update
+        self.expansions = 0 # Cells expanded in the last update
+
+    # Octile distance between two cells (admissible as costs are >= 1)
+    def heuristic(self, a, b):
+        dy = abs(self.rows[a] - self.rows[b])
+        dx = abs(self.cols[a] - self.cols[b])
+        return dy + dx + (math.sqrt(2) - 2) * min(dy, dx)
+
+    def key(self, cell):
+        best = min(self.g[cell], self.rhs[cell])
+        return (best + self.heuristic(self.start, cell) + self.km, best)
+
+    def update_vertex(self, cell):
+        if cell in self.goals:
+            self.rhs[cell] = 0.
+        else:
+            cost, g = self.cost, self.g
+            cell_cost = cost[cell]
+            self.rhs[cell] = min([half_step * (cell_cost + cost[cell + offset]) + g[cell + offset]
+                                  for offset, half_step in self.offsets])
+        if self.g[cell] != self.rhs[cell]:
+            key = self.key(cell)
+            if self.queued.get(cell) != key:
+                self.queued[cell] = key
+                heapq.heappush(self.queue, (key, cell))
+        else:
+            self.queued.pop(cell, None)
+
+    # Update a cell's neighbours (the border cells never change)
+    def update_neighbours(self, cell):
+        inside = self.inside
+        for offset, half_step in self.offsets:
+            if inside[cell + offset]:
+                self.update_vertex(cell + offset)
+
+    # Expand cells until the rover's cell is consistent (or out of budget)
+    def compute_shortest_path(self):
+        expansions = 0
+        queue, queued, g, rhs = self.queue, self.queued, self.g, self.rhs
+        start = self.start
+        while queue and expansions < self.max_expansions:
+            key_old, cell = queue[0]
+            if queued.get(cell) != key_old:
+                heapq.heappop(queue)
+                continue
+            if key_old >= self.key(start) and rhs[start] == g[start]:
+                break
+            heapq.heappop(queue)
+            expansions += 1
+            key_new = self.key(cell)
+            if key_old < key_new:
+                queued[cell] = key_new
+                heapq.heappush(queue, (key_new, cell))
+            elif g[cell] > rhs[cell]:
+                g[cell] = rhs[cell]
+                del queued[cell]
+                self.update_neighbours(cell)
+            else:
+                g[cell] = inf
+                self.update_vertex(cell)
+                self.update_neighbours(cell)
+        return expansions
+
+    # Derive the occupancy grid and frontiers from the worldmap (summing
+    # blocks of cells if the worldmap is finer than the grid)
+    def read_worldmap(self, worldmap):
+        block = worldmap.shape[0] // self.size
+        nav = worldmap[:,:,2].astype(np.int64)
+        obs = worldmap[:,:,0].astype(np.int64)
+        if block > 1:
+            nav = nav.reshape(self.size, block, self.size, block).sum(axis=(1, 3))
+            obs = obs.reshape(self.size, block, self.size, block).sum(axis=(1, 3))
+        # Compare the number of frames that saw each class (cross multiplied
+        # by the evidence added per frame)
+        nav_hits = nav * self.evidence_amounts[0]
+        obs_hits = obs * self.evidence_amounts[2]
+        state = np.where(nav_hits > obs_hits, FREE, np.where(obs_hits > 0, BLOCKED, UNKNOWN))
+        unknown = np.pad(state == UNKNOWN, 1, mode='constant')
+        next_to_unknown = unknown[:-2, 1:-1] | unknown[2:, 1:-1] | unknown[1:-1, :-2] | unknown[1:-1, 2:]
+        frontier = (state == FREE) & next_to_unknown & ~self.visited
+        return state.astype(np.int8).ravel(), frontier.ravel()
+
+    # Update the plan for the Rover's current worldmap and position and set
+    # Rover.waypoint and Rover.waypoint_heading (degrees relative to the
+    # Rover's heading, positive to the left, None without a frontier)
+    def update(self, Rover):
+        t0 = time.perf_counter()
+        resolution = self.size / world_meters
+        x = min(max(int(Rover.pos[0] * resolution), 0), self.size - 1)
+        y = min(max(int(Rover.pos[1] * resolution), 0), self.size - 1)
+        start = (y + 1) * self.width + x + 1
+        if self.start is None:
+            self.start = start
+        elif start != self.start:
+            self.km += self.heuristic(self.start, start)
+            self.start = start
+        radius = self.visit_radius
+        self.visited[max(y - radius, 0):y + radius + 1, max(x - radius, 0):x + radius + 1] = True
+        # Only the cells whose state or frontier status changed, and the
+        # neighbours of cells whose cost changed, need updating
+        state, frontier = self.read_worldmap(Rover.worldmap)
+        changed_state = np.flatnonzero(state != self.state)
+        changed_goal = np.flatnonzero(frontier != self.frontier)
+        for cell, is_goal in zip(self.padded[changed_goal].tolist(), frontier[changed_goal].tolist()):
+            if is_goal:
+                self.goals.add(cell)
+            else:
+                self.goals.discard(cell)
+        for cell, cell_state in zip(self.padded[changed_state].tolist(), state[changed_state].tolist()):
+            self.cost[cell] = cell_costs[cell_state]
+        self.state, self.frontier = state, frontier
+        affected = set(self.padded[changed_goal].tolist())
+        for cell in self.padded[changed_state].tolist():
+            affected.add(cell)
+            affected.update(cell + offset for offset, half_step in self.offsets
+                            if self.inside[cell + offset])
+        for cell in affected:
+            self.update_vertex(cell)
+        self.expansions = self.compute_shortest_path()
+        self.path = self.extract_path()
+        Rover.waypoint = None
+        Rover.waypoint_heading = None
+        if len(self.path) > 1:
+            wy, wx = divmod(self.path[-1], self.width)
+            # Waypoint at the cell center, in meters
+            Rover.waypoint = ((wx - 0.5) / resolution, (wy - 0.5) / resolution)
+            heading = math.degrees(math.atan2(Rover.waypoint[1] - Rover.pos[1],
+                                              Rover.waypoint[0] - Rover.pos[0]))
+            Rover.waypoint_heading = (heading - Rover.yaw + 180) % 360 - 180
+        self.waypoint = Rover.waypoint
+        self.plan_time = time.perf_counter() - t0
+        Rover.plan_time = self.plan_time
+        return Rover.waypoint_heading
+
+    # Follow the cheapest neighbours from the rover for up to lookahead steps
+    def extract_path(self):
+        cell = self.start
+        path = [cell]
+        cost, g = self.cost, self.g
+        if g[cell] == inf:
+            return path
+        for idx in range(self.lookahead):
+            if cell in self.goals:
+                break
+            cell_cost = cost[cell]
+            cell = min([(half_step * (cell_cost + cost[cell + offset]) + g[cell + offset], cell + offset)
+                        for offset, half_step in self.offsets])[1]
+            path.append(cell)
+        return path
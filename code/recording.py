@@ -0,0 +1,216 @@
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# A recording is a folder of fixed size chunks.  Chunk N is stored as
+#   frames_N.npy:  (chunk_size, rows, cols, 3) uint8 camera frames
+#   records_N.npy: (chunk_size,) structured array of record_dtype
+# plus meta.json holding the chunk size, frame shape and frame count.
+# Both .npy files are written and read through memory maps, so any frame
+# range can be accessed without decoding individual image files.
+record_dtype = np.dtype([
+    ('time', np.float64), # Wall clock time the frame was received
+    ('total_time', np.float32), # Time since the start of the run
+    # Telemetry
+    ('speed', np.float32),
+    ('xpos', np.float32),
+    ('ypos', np.float32),
+    ('yaw', np.float32),
+    ('pitch', np.float32),
+    ('roll', np.float32),
+    ('throttle', np.float32),
+    ('brake', np.float32),
+    ('steer', np.float32),
+    ('near_sample', np.uint8),
+    ('picking_up', np.uint8),
+    ('samples_collected', np.int16),
+    # Command sent in response
+    ('cmd_throttle', np.float32),
+    ('cmd_brake', np.float32),
+    ('cmd_steer', np.float32),
+    ('cmd_pickup', np.uint8),
+    # Perception outputs
+    ('nav_count', np.int32), # Number of navigable terrain pixels
+    ('nav_mean_angle', np.float32), # Mean angle of navigable terrain (radians)
+    ('nav_mean_dist', np.float32), # Mean distance of navigable terrain (pixels)
+])
+
+# Define a function to build a record from the Rover state and the reply sent.
+# telemetry is the (throttle, brake, steer) reported by the simulator (taken
+# before decision_step replaces them with the new commands) and commands is
+# the (throttle, brake, steer) sent, or None if a pickup was sent.
+def make_record(Rover, telemetry, commands):
+    record = np.zeros((), dtype=record_dtype)
+    record['time'] = time.time()
+    record['total_time'] = Rover.total_time or 0
+    record['speed'] = Rover.vel
+    record['xpos'], record['ypos'] = Rover.pos[0], Rover.pos[1]
+    record['yaw'] = Rover.yaw
+    record['pitch'] = Rover.pitch
+    record['roll'] = Rover.roll
+    record['throttle'], record['brake'], record['steer'] = telemetry
+    record['near_sample'] = Rover.near_sample
+    record['picking_up'] = Rover.picking_up
+    record['samples_collected'] = Rover.samples_collected
+    if commands is None:
+        record['cmd_pickup'] = 1
+    else:
+        record['cmd_throttle'], record['cmd_brake'], record['cmd_steer'] = commands
+    if Rover.nav_summary is not None:
+        record['nav_count'] = Rover.nav_summary.count
+        record['nav_mean_angle'] = Rover.nav_summary.mean_angle
+        record['nav_mean_dist'] = Rover.nav_summary.mean_dist
+    return record
+
+# Define a class that appends frames and records to a recording from a
+# background writer thread.  append() only copies the frame and queues it,
+# so the telemetry handler never waits on disk I/O.  If the writer falls
+# behind by more than max_queue frames, new frames are dropped and counted.
+# A frame that fails to write (disk full, unexpected shape) is counted too
+# and the first error is kept, but the writer goes on draining the queue.
+class Recorder():
+    def __init__(self, path, chunk_size=1000, frame_shape=(160, 320, 3), max_queue=256):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.frame_shape = tuple(frame_shape)
+        self.count = 0 # Frames written so far
+        self.dropped = 0 # Frames dropped because the queue was full
+        self.failed = 0 # Frames that failed to write
+        self.error = None # First write error
+        self.frames = None # Memory map of the current chunk's frames
+        self.records = None # Memory map of the current chunk's records
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    # Queue a frame (copied, as the decoder reuses its image buffer) and its record
+    def append(self, img, record):
+        if not self.writer.is_alive():
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait((np.array(img, dtype=np.uint8), record))
+        except queue.Full:
+            self.dropped += 1
+
+    # Flush everything queued so far and stop the writer thread.  This waits
+    # for the queued frames to be written.
+    def close(self):
+        while self.writer.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                break
+            except queue.Full:
+                pass
+        self.writer.join()
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.write(*item)
+            except Exception as error:
+                self.failed += 1
+                if self.error is None:
+                    self.error = error
+                    print("Recording to {}: frame {} failed to write: {!r}".format(
+                        self.path, self.count, error))
+        try:
+            self.flush()
+        except Exception as error:
+            self.error = self.error or error
+            print("Recording to {}: flush failed: {!r}".format(self.path, error))
+
+    def write(self, img, record):
+        chunk, row = divmod(self.count, self.chunk_size)
+        if row == 0:
+            self.flush()
+            self.frames = np.lib.format.open_memmap(
+                chunk_file(self.path, 'frames', chunk), mode='w+', dtype=np.uint8,
+                shape=(self.chunk_size,) + self.frame_shape)
+            self.records = np.lib.format.open_memmap(
+                chunk_file(self.path, 'records', chunk), mode='w+', dtype=record_dtype,
+                shape=(self.chunk_size,))
+        self.frames[row] = img
+        self.records[row] = record
+        self.count += 1
+
+    # Write the current chunk to disk and update meta.json
+    def flush(self):
+        if self.frames is not None:
+            self.frames.flush()
+            self.records.flush()
+        meta = {'chunk_size': self.chunk_size, 'frame_shape': list(self.frame_shape),
+                'count': self.count}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+# Define a function to return the file name of a chunk
+def chunk_file(path, kind, chunk):
+    return os.path.join(path, '{}_{:05d}.npy'.format(kind, chunk))
+
+# Define a class to read a recording with random access to any frame range.
+# Chunks are memory mapped read-only on first use.
+class RecordingReader():
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.chunk_size = meta['chunk_size']
+        self.frame_shape = tuple(meta['frame_shape'])
+        self.count = meta['count']
+        self.chunks = {}
+
+    def __len__(self):
+        return self.count
+
+    def chunk(self, idx):
+        if idx not in self.chunks:
+            self.chunks[idx] = (np.load(chunk_file(self.path, 'frames', idx), mmap_mode='r'),
+                                np.load(chunk_file(self.path, 'records', idx), mmap_mode='r'))
+        return self.chunks[idx]
+
+    # Return a single (frame, record) pair
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError('frame {} out of range'.format(idx))
+        chunk, row = divmod(idx, self.chunk_size)
+        frames, records = self.chunk(chunk)
+        return frames[row], records[row]
+
+    # Yield (start index, frames, records) blocks covering [start, stop).
+    # Blocks never span a chunk, so they are views of the memory maps.
+    def iter_blocks(self, start=0, stop=None):
+        if stop is None or stop > self.count:
+            stop = self.count
+        while start < stop:
+            chunk, row = divmod(start, self.chunk_size)
+            end = min(stop - start, self.chunk_size - row) + row
+            frames, records = self.chunk(chunk)
+            yield start, frames[row:end], records[row:end]
+            start += end - row
+
+    # Return the frames and records of [start, stop) as arrays
+    def read(self, start=0, stop=None):
+        blocks = list(self.iter_blocks(start, stop))
+        if len(blocks) == 1:
+            return blocks[0][1], blocks[0][2]
+        if not blocks:
+            return np.zeros((0,) + self.frame_shape, dtype=np.uint8), np.zeros(0, dtype=record_dtype)
+        return np.concatenate([block[1] for block in blocks]), \
+               np.concatenate([block[2] for block in blocks])
+
+    # Stream (frame, record) pairs for [start, stop)
+    def iter_frames(self, start=0, stop=None):
+        for first, frames, records in self.iter_blocks(start, stop):
+            for row in range(len(frames)):
+                yield frames[row], records[row]
@@ -0,0 +1,158 @@
+import argparse
+import csv
+import os
+from collections import namedtuple
+from multiprocessing import Pool
+import cv2
+import numpy as np
+
+from perception import perception_batch, update_worldmap_batch
+from recording import RecordingReader
+from worldmap import new_worldmap, merge_worldmaps
+
+# One row of a recorded robot_log.csv
+LogRecord = namedtuple('LogRecord', ['path', 'steer', 'throttle', 'brake', 'speed',
+                                     'xpos', 'ypos', 'pitch', 'yaw', 'roll'])
+
+# Define a function to convert log strings to float independent of decimal convention
+def log_float(string_to_convert):
+    return float(string_to_convert.replace(',', '.'))
+
+# Define a function to find an image listed in the log.  The recorder writes
+# paths relative to wherever it was run from, so fall back to the IMG folder
+# next to the log file if the path doesn't resolve as is
+def resolve_image_path(path, log_dir):
+    if os.path.isabs(path) and os.path.exists(path):
+        return path
+    candidate = os.path.normpath(os.path.join(log_dir, path))
+    if os.path.exists(candidate):
+        return candidate
+    return os.path.join(log_dir, 'IMG', os.path.basename(path.replace('\\', '/')))
+
+# Define a function to read robot_log.csv (or a recording folder written
+# by drive_rover.py) into a list of LogRecords
+def read_log(csv_path):
+    if os.path.isdir(csv_path):
+        return read_recording_log(csv_path)
+    log_dir = os.path.dirname(os.path.abspath(csv_path))
+    records = []
+    with open(csv_path, newline='') as f:
+        reader = csv.reader(f, delimiter=';')
+        # Skip the header row
+        next(reader)
+        for row in reader:
+            if not row:
+                continue
+            values = [log_float(value) for value in row[1:10]]
+            records.append(LogRecord(resolve_image_path(row[0], log_dir), *values))
+    return records
+
+# Define a function to read a recording folder into a list of LogRecords.
+# The path of each record is a (recording folder, frame index) pair.
+def read_recording_log(path):
+    records = RecordingReader(path).read()[1]
+    return [LogRecord((path, idx), float(row['steer']), float(row['throttle']),
+                      float(row['brake']), float(row['speed']), float(row['xpos']),
+                      float(row['ypos']), float(row['pitch']), float(row['yaw']),
+                      float(row['roll']))
+            for idx, row in enumerate(records)]
+
+# Open recordings, by folder
+recordings = {}
+
+# Define a function to read a camera image from disk as an RGB uint8 array.
+# A (recording folder, frame index) pair reads the frame from a recording.
+def read_image(path):
+    if isinstance(path, tuple):
+        folder, idx = path
+        if folder not in recordings:
+            recordings[folder] = RecordingReader(folder)
+        return np.array(recordings[folder][idx][0])
+    return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+
+# Define a function to build a simulator style telemetry message for a
+# log record, with the camera image as a base64 encoded JPEG
+def synthesize_telemetry(record, image_string):
+    return {
+        'speed': str(record.speed),
+        'position': '{};{}'.format(record.xpos, record.ypos),
+        'yaw': str(record.yaw),
+        'pitch': str(record.pitch),
+        'roll': str(record.roll),
+        'throttle': str(record.throttle),
+        'steering_angle': str(record.steer),
+        'brake': str(record.brake),
+        'near_sample': '0',
+        'picking_up': '0',
+        'sample_count': '6',
+        'samples_x': '100;120;60;140;80;110',
+        'samples_y': '90;100;50;160;130;70',
+        'image': image_string,
+    }
+
+# Define a function to run perception over a sequence of records and
+# return the worldmap accumulated from them.  Frames are processed in
+# stacks of batch_size with the batched perception API.
+def replay_records(records, world_size=200, batch_size=64):
+    worldmap = new_worldmap(world_size)
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        imgs = np.stack([read_image(record.path) for record in batch])
+        masks, nav_stats, world = perception_batch(
+            imgs, [record.xpos for record in batch], [record.ypos for record in batch],
+            [record.yaw for record in batch], world_size, with_masks=False)
+        update_worldmap_batch(worldmap, world)
+    return worldmap
+
+# Worker entry point for the process pool
+def replay_shard(args):
+    records, world_size = args
+    return replay_records(records, world_size)
+
+# Define a function to replay a whole log across a process pool.  Each worker
+# builds a partial worldmap over a contiguous shard of frames and since
+# worldmap updates are additive the partial maps are summed into one map
+# (world_size is cells per side, larger than 200 for a finer map)
+def replay_log(csv_path, workers=None, world_size=200, records=None):
+    if records is None:
+        records = read_log(csv_path)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(records)))
+    if workers == 1:
+        return replay_records(records, world_size)
+    bounds = np.linspace(0, len(records), workers + 1).astype(int)
+    shards = [(records[start:stop], world_size) for start, stop in zip(bounds[:-1], bounds[1:])]
+    worldmap = new_worldmap(world_size)
+    with Pool(workers) as pool:
+        for partial in pool.imap_unordered(replay_shard, shards):
+            merge_worldmaps(worldmap, partial)
+    return worldmap
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline perception replay')
+    parser.add_argument(
+        'log',
+        type=str,
+        nargs='?',
+        default='../test_dataset/robot_log.csv',
+        help='Path to the robot_log.csv of a recorded run, or a drive_rover.py recording folder.'
+    )
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: all cores).')
+    parser.add_argument('--world_size', type=int, default=200,
+                        help='Worldmap cells per side (200 is one cell per meter).')
+    parser.add_argument('--output', type=str, default='',
+                        help='Save the accumulated worldmap to this .npy file.')
+    args = parser.parse_args()
+
+    records = read_log(args.log)
+    print("Replaying {} frames from {}".format(len(records), args.log))
+    worldmap = replay_log(args.log, workers=args.workers,
+                          world_size=args.world_size, records=records)
+    print("Navigable cells: {}, obstacle cells: {}, rock cells: {}".format(
+        np.count_nonzero(worldmap[:,:,2]), np.count_nonzero(worldmap[:,:,0]),
+        np.count_nonzero(worldmap[:,:,1])))
+    if args.output != '':
+        np.save(args.output, worldmap)
+        print("Saved worldmap to {}".format(args.output))
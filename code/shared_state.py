@@ -0,0 +1,146 @@
+import argparse
+import time
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+from recording import record_dtype
+from worldmap import map_dtype
+
+# A shared state block holds the latest state of one rover for readers in
+# other processes:
+#   header:       int64 [seq, frames, world_size, rows, cols, record size]
+#   record:       one record_dtype record (telemetry, commands, perception)
+#   worldmap:     (world_size, world_size, 3) map_dtype evidence counters
+#   vision_image: (rows, cols, 3) uint8 perception output image
+# The sections start on 64 byte boundaries.  seq is a seqlock counter: the
+# publisher makes it odd while writing and even again when done, so a reader
+# has a consistent snapshot if seq was even and unchanged around its reads.
+header_fields = 6
+SEQ, FRAMES, WORLD_SIZE, ROWS, COLS, RECORD_SIZE = range(header_fields)
+
+# Define a function to round a byte offset up to the next section boundary
+def align(offset, boundary=64):
+    return (offset + boundary - 1) // boundary * boundary
+
+# Define a function to return the byte offsets of the record, worldmap and
+# vision image sections and the total size of a block
+def block_layout(world_size, rows, cols):
+    record = align(header_fields * np.dtype(np.int64).itemsize)
+    worldmap = align(record + record_dtype.itemsize)
+    vision_image = align(worldmap + world_size * world_size * 3 * np.dtype(map_dtype).itemsize)
+    return record, worldmap, vision_image, vision_image + rows * cols * 3
+
+# Define a function to create the header, record, worldmap and vision image
+# arrays over a shared memory buffer
+def map_sections(buf, world_size, rows, cols):
+    record, worldmap, vision_image, size = block_layout(world_size, rows, cols)
+    return (np.ndarray((header_fields,), dtype=np.int64, buffer=buf),
+            np.ndarray((), dtype=record_dtype, buffer=buf, offset=record),
+            np.ndarray((world_size, world_size, 3), dtype=map_dtype, buffer=buf, offset=worldmap),
+            np.ndarray((rows, cols, 3), dtype=np.uint8, buffer=buf, offset=vision_image))
+
+# Define a class that publishes a rover's state into a named shared memory
+# block (see above).  publish() only copies into the block, so it costs a
+# few hundred kB of memcpy per frame whatever the number of readers.
+class SharedStatePublisher():
+    def __init__(self, name, world_size=200, frame_shape=(160, 320)):
+        rows, cols = frame_shape
+        # Replace a block left behind by a previous run
+        try:
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self.shm = shared_memory.SharedMemory(name, create=True,
+                                              size=block_layout(world_size, rows, cols)[-1])
+        self.name = name
+        self.header, self.record, self.worldmap, self.vision_image = \
+            map_sections(self.shm.buf, world_size, rows, cols)
+        self.header[:] = 0
+        self.header[WORLD_SIZE], self.header[ROWS], self.header[COLS] = world_size, rows, cols
+        self.header[RECORD_SIZE] = record_dtype.itemsize
+
+    # Publish a record (see make_record) with the Rover's worldmap and
+    # vision image
+    def publish(self, Rover, record):
+        header = self.header
+        header[SEQ] += 1 # Odd: write in progress
+        self.record[...] = record
+        self.worldmap[...] = Rover.worldmap
+        np.copyto(self.vision_image, Rover.vision_image, casting='unsafe')
+        header[FRAMES] += 1
+        header[SEQ] += 1 # Even: consistent
+
+    def close(self):
+        # Release the arrays before the buffer they point into
+        self.header = self.record = self.worldmap = self.vision_image = None
+        self.shm.close()
+        self.shm.unlink()
+
+# Define a class that attaches to a published shared state block.  The
+# arrays (header, record, worldmap, vision_image) are views of the block,
+# i.e. zero-copy but possibly mid-update; read() returns a consistent copy.
+class SharedStateReader():
+    def __init__(self, name):
+        self.shm = shared_memory.SharedMemory(name)
+        # Attaching registers the block with this process's resource
+        # tracker, which would unlink it when the reader exits
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name = name
+        header = np.ndarray((header_fields,), dtype=np.int64, buffer=self.shm.buf)
+        if header[RECORD_SIZE] != record_dtype.itemsize:
+            raise ValueError('Shared state block {} has an incompatible record layout'.format(name))
+        self.header, self.record, self.worldmap, self.vision_image = map_sections(
+            self.shm.buf, int(header[WORLD_SIZE]), int(header[ROWS]), int(header[COLS]))
+
+    # Sequence number of the last completed update (odd while one is in
+    # progress), to check whether anything changed since the last read
+    @property
+    def seq(self):
+        return int(self.header[SEQ])
+
+    # Return a consistent copy of (seq, record, worldmap, vision_image),
+    # retrying while the publisher is writing (None if it never settles)
+    def read(self, retries=100):
+        for attempt in range(retries):
+            seq = int(self.header[SEQ])
+            if seq % 2 == 0:
+                snapshot = (self.record.copy(), self.worldmap.copy(), self.vision_image.copy())
+                if int(self.header[SEQ]) == seq:
+                    return (seq,) + snapshot
+            time.sleep(0)
+        return None
+
+    def close(self):
+        self.header = self.record = self.worldmap = self.vision_image = None
+        self.shm.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monitor a rover published with drive_rover.py --shared_memory')
+    parser.add_argument('name', type=str, help='Shared memory block name, e.g. rover_0.')
+    parser.add_argument('--rate', type=float, default=2, help='Reads per second.')
+    parser.add_argument('--output', type=str, default='',
+                        help='Save the worldmap to this .npy file on exit.')
+    args = parser.parse_args()
+
+    reader = SharedStateReader(args.name)
+    last_seq = None
+    worldmap = None
+    try:
+        while True:
+            snapshot = reader.read()
+            if snapshot is not None and snapshot[0] != last_seq:
+                last_seq, record, worldmap, vision_image = snapshot
+                print("frame {}: pos ({:.1f}, {:.1f}) yaw {:.0f} speed {:.2f}, "
+                      "navigable cells {}, obstacle cells {}".format(
+                          int(reader.header[FRAMES]), float(record['xpos']), float(record['ypos']),
+                          float(record['yaw']), float(record['speed']),
+                          np.count_nonzero(worldmap[:,:,2]), np.count_nonzero(worldmap[:,:,0])))
+            time.sleep(1 / args.rate)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.output != '' and worldmap is not None:
+            np.save(args.output, worldmap)
+        reader.close()
@@ -0,0 +1,233 @@
+import argparse
+import base64
+import threading
+import time
+from collections import deque
+import numpy as np
+import cv2
+import socketio
+
+from perception import get_perspective_matrix, source, destination, world_scale
+from replay import LogRecord, read_log, synthesize_telemetry
+from worldmap import load_ground_truth
+
+# Colors of the synthesized camera images: bright ground (navigable with the
+# default thresholds), dark rock walls and the sky above the horizon
+ground_color = (190, 175, 165)
+wall_color = (95, 75, 60)
+sky_color = (105, 125, 150)
+
+# Define a function to load test_dataset style frames as telemetry messages
+def dataset_frames(log):
+    frames = []
+    for record in read_log(log):
+        with open(record.path, 'rb') as f:
+            frames.append(synthesize_telemetry(record, base64.b64encode(f.read()).decode('utf-8')))
+    return frames
+
+# Define a class that renders camera images from the ground truth map by
+# inverse perspective rendering.  Every camera pixel is mapped once through
+# the calibrated perspective transform to rover-centric ground coordinates;
+# each frame then only rotates and translates them to the pose and looks up
+# the ground truth.  Ground beyond max_range meters is drawn as sky.
+class GroundTruthCamera():
+    def __init__(self, ground_truth, shape=(160, 320), max_range=30):
+        self.ground_truth = ground_truth
+        self.shape = shape
+        rows, cols = shape
+        ygrid, xgrid = np.mgrid[0:rows, 0:cols]
+        M = get_perspective_matrix(source, destination)
+        dst = M.dot(np.vstack((xgrid.ravel(), ygrid.ravel(), np.ones(rows * cols))))
+        # Pixels above the horizon have the opposite homogeneous sign to
+        # the calibration points
+        facing = np.sign(M.dot([source[0][0], source[0][1], 1])[2])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dst_x = dst[0] / dst[2]
+            dst_y = dst[1] / dst[2]
+        # Rover-centric coords (in warped image pixels) like rover_coords()
+        xpix = -(dst_y - rows)
+        ypix = -(dst_x - cols / 2)
+        ground = (dst[2] * facing > 0) & (xpix > 0) & (xpix < max_range * world_scale)
+        self.ground = np.flatnonzero(ground) # Flat indices of the ground pixels
+        self.xpix = (xpix[ground] / world_scale).astype(np.float32)
+        self.ypix = (ypix[ground] / world_scale).astype(np.float32)
+        # Sky filled image to draw the ground into, and the ground colors
+        self.sky = np.empty((rows, cols, 3), dtype=np.uint8)
+        self.sky[:] = sky_color
+        self.palette = np.array([wall_color, ground_color], dtype=np.uint8)
+
+    # Render the RGB camera image seen from (x, y) meters with yaw degrees
+    def render(self, x, y, yaw):
+        yaw_rad = yaw * np.pi / 180
+        cos_yaw, sin_yaw = np.float32(np.cos(yaw_rad)), np.float32(np.sin(yaw_rad))
+        x_world = self.xpix * cos_yaw - self.ypix * sin_yaw + np.float32(x)
+        y_world = self.xpix * sin_yaw + self.ypix * cos_yaw + np.float32(y)
+        size = self.ground_truth.size
+        np.clip(x_world, 0, size - 1, out=x_world)
+        np.clip(y_world, 0, size - 1, out=y_world)
+        cells = y_world.astype(np.intp) * size + x_world.astype(np.intp)
+        navigable = self.ground_truth.nav.ravel().take(cells)
+        img = self.sky.copy()
+        img.reshape(-1, 3)[self.ground] = self.palette[navigable.view(np.uint8)]
+        return img
+
+    # Return whether (x, y) meters is navigable ground
+    def navigable(self, x, y):
+        size = self.ground_truth.size
+        return 0 <= x < size and 0 <= y < size and bool(self.ground_truth.nav[int(y), int(x)])
+
+# Define a function to synthesize telemetry frames along a random walk over
+# the navigable ground truth: drive straight and turn by a random angle
+# whenever the ground lookahead meters ahead isn't navigable
+def synthetic_frames(ground_truth, count, speed=1., fps=20, lookahead=3., seed=0):
+    camera = GroundTruthCamera(ground_truth)
+    rng = np.random.RandomState(seed)
+    nav_y, nav_x = np.nonzero(ground_truth.nav)
+    start = rng.randint(len(nav_x))
+    x, y, yaw = nav_x[start] + 0.5, nav_y[start] + 0.5, rng.uniform(0, 360)
+    frames = []
+    for idx in range(count):
+        yaw_rad = yaw * np.pi / 180
+        if camera.navigable(x + lookahead * np.cos(yaw_rad), y + lookahead * np.sin(yaw_rad)):
+            x += speed / fps * np.cos(yaw_rad)
+            y += speed / fps * np.sin(yaw_rad)
+        else:
+            yaw = (yaw + rng.choice([-1, 1]) * rng.uniform(15, 45)) % 360
+        bgr = cv2.cvtColor(camera.render(x, y, yaw), cv2.COLOR_RGB2BGR)
+        image_string = base64.b64encode(cv2.imencode('.jpg', bgr)[1].tobytes()).decode('utf-8')
+        record = LogRecord(None, 0., 0.2, 0., speed, x, y, 0., yaw, 0.)
+        frames.append(synthesize_telemetry(record, image_string))
+    return frames
+
+# Define a class for one virtual rover: a socket.io client that sends
+# telemetry frames to drive_rover.py and times the replies.  The server
+# answers the frames of one client in order, so replies ('data' or 'pickup')
+# are matched to frames first in, first out.  In closed loop mode (like the
+# simulator) the next frame is only sent once the last one was answered,
+# otherwise frames are sent at the given rate regardless of replies.
+class VirtualRover():
+    def __init__(self, url, frames, rate=20, closed_loop=True, timeout=2., offset=0):
+        self.url = url
+        self.frames = frames
+        self.interval = 1 / rate if rate > 0 else 0
+        self.closed_loop = closed_loop
+        self.timeout = timeout # Seconds to wait for a reply before giving up on it
+        self.offset = offset # First frame, so rovers don't all send the same frames
+        self.sent = 0
+        self.received = 0
+        self.pickups = 0
+        self.rtts = [] # Round trip times (seconds)
+        self.outstanding = deque() # Send times of unanswered frames
+        self.lock = threading.Lock()
+        self.replied = threading.Event()
+        self.ready = threading.Event() # Set by the reply to connecting
+        self.client = socketio.Client()
+        self.client.on('data', self.on_reply)
+        self.client.on('pickup', self.on_pickup)
+
+    def on_reply(self, data=None):
+        now = time.perf_counter()
+        with self.lock:
+            if not self.ready.is_set():
+                # The server sends null commands when a client connects
+                self.ready.set()
+                return
+            if self.outstanding:
+                self.rtts.append(now - self.outstanding.popleft())
+                self.received += 1
+        self.replied.set()
+
+    def on_pickup(self, data=None):
+        self.pickups += 1
+        self.on_reply(data)
+
+    def send(self):
+        with self.lock:
+            self.outstanding.append(time.perf_counter())
+            self.replied.clear()
+        self.client.emit('telemetry', self.frames[(self.offset + self.sent) % len(self.frames)])
+        self.sent += 1
+
+    # Send frames for duration seconds, then wait for the last replies
+    def run(self, duration):
+        self.client.connect(self.url)
+        self.ready.wait(self.timeout)
+        self.ready.set()
+        start = time.perf_counter()
+        next_send = start
+        while time.perf_counter() - start < duration:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.send()
+            next_send = max(next_send + self.interval, time.perf_counter() - self.interval)
+            if self.closed_loop:
+                self.replied.wait(self.timeout)
+        self.duration = time.perf_counter() - start
+        deadline = time.perf_counter() + self.timeout
+        while self.outstanding and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        self.client.disconnect()
+
+    # Return the rover's results
+    def results(self):
+        rtts = np.array(self.rtts) * 1000
+        p50, p95, p99 = np.percentile(rtts, [50, 95, 99]) if len(rtts) else (np.nan,) * 3
+        return {'sent': self.sent,
+                'received': self.received,
+                'dropped': self.sent - self.received,
+                'pickups': self.pickups,
+                'fps': round(self.received / self.duration, 1),
+                'rtt_p50_ms': round(float(p50), 2),
+                'rtt_p95_ms': round(float(p95), 2),
+                'rtt_p99_ms': round(float(p99), 2)}
+
+# Define a function to run rovers virtual rovers against one server
+# concurrently and return the results of each
+def run_load_test(url, frames, rovers=1, duration=10., rate=20, closed_loop=True):
+    fleet = [VirtualRover(url, frames, rate, closed_loop, offset=idx * len(frames) // rovers)
+             for idx in range(rovers)]
+    threads = [threading.Thread(target=rover.run, args=(duration,)) for rover in fleet]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [rover.results() for rover in fleet]
+
+def print_results(results):
+    print("{:>6} {:>7} {:>9} {:>8} {:>7} {:>9} {:>9} {:>9}".format(
+        'rover', 'sent', 'received', 'dropped', 'fps', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for idx, stats in enumerate(results):
+        print("{:>6} {:>7} {:>9} {:>8} {:>7} {:>9} {:>9} {:>9}".format(
+            idx, stats['sent'], stats['received'], stats['dropped'], stats['fps'],
+            stats['rtt_p50_ms'], stats['rtt_p95_ms'], stats['rtt_p99_ms']))
+    print("Total: {} sent, {} received, {} dropped, {:.1f} replies/sec".format(
+        sum(stats['sent'] for stats in results), sum(stats['received'] for stats in results),
+        sum(stats['dropped'] for stats in results), sum(stats['fps'] for stats in results)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless simulator stand-in for load testing drive_rover.py')
+    parser.add_argument('--url', type=str, default='http://localhost:4567',
+                        help='URL of the drive_rover.py server.')
+    parser.add_argument('--rovers', type=int, default=1,
+                        help='Number of virtual rovers connected at once.')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds to send frames for.')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='Frames per second per rover (0 for as fast as possible).')
+    parser.add_argument('--open_loop', action='store_true',
+                        help='Send at the rate without waiting for replies (default waits, '
+                             'like the simulator).')
+    parser.add_argument('--log', type=str, default='../test_dataset/robot_log.csv',
+                        help='robot_log.csv of the frames to replay.')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Instead of the log, render this many frames from the ground truth map.')
+    args = parser.parse_args()
+
+    if args.synthetic > 0:
+        frames = synthetic_frames(load_ground_truth('../calibration_images/map_bw.png'), args.synthetic)
+    else:
+        frames = dataset_frames(args.log)
+    print("Driving {} rover(s) for {} s with {} frames".format(args.rovers, args.duration, len(frames)))
+    print_results(run_load_test(args.url, frames, args.rovers, args.duration,
+                                args.rate, not args.open_loop))
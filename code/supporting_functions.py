@@ -4,129 +4,213 @@ from PIL import Image
 from io import BytesIO, StringIO
 import base64
 import time
+from worldmap import add_evidence, cell_index, SampleIndex
 
 # Define a function to convert telemetry strings to float independent of decimal convention
 def convert_to_float(string_to_convert):
-      if ',' in string_to_convert:
-            float_value = np.float(string_to_convert.replace(',','.'))
-      else: 
-            float_value = np.float(string_to_convert)
-      return float_value
-
-def update_rover(Rover, data):
-      # Initialize start time and sample positions
-      if Rover.start_time == None:
-            Rover.start_time = time.time()
-            Rover.total_time = 0
-            samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
-            samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
-            Rover.samples_pos = (samples_xpos, samples_ypos)
-            Rover.samples_to_find = np.int(data["sample_count"])
-      # Or just update elapsed time
-      else:
-            tot_time = time.time() - Rover.start_time
-            if np.isfinite(tot_time):
-                  Rover.total_time = tot_time
-      # Print out the fields in the telemetry data dictionary
-      print(data.keys())
-      # The current speed of the rover in m/s
-      Rover.vel = convert_to_float(data["speed"])
-      # The current position of the rover
-      Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
-      # The current yaw angle of the rover
-      Rover.yaw = convert_to_float(data["yaw"])
-      # The current yaw angle of the rover
-      Rover.pitch = convert_to_float(data["pitch"])
-      # The current yaw angle of the rover
-      Rover.roll = convert_to_float(data["roll"])
-      # The current throttle setting
-      Rover.throttle = convert_to_float(data["throttle"])
-      # The current steering angle
-      Rover.steer = convert_to_float(data["steering_angle"])
-      # Near sample flag
-      Rover.near_sample = np.int(data["near_sample"])
-      # Picking up flag
-      Rover.picking_up = np.int(data["picking_up"])
-      # Update number of rocks collected
-      Rover.samples_collected = Rover.samples_to_find - np.int(data["sample_count"])
-
-      print('speed =',Rover.vel, 'position =', Rover.pos, 'throttle =', 
-      Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample, 
-      'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup, 
-      'total time:', Rover.total_time, 'samples remaining:', data["sample_count"], 
-      'samples collected:', Rover.samples_collected)
-      # Get the current image from the center camera of the rover
-      imgString = data["image"]
-      image = Image.open(BytesIO(base64.b64decode(imgString)))
-      Rover.img = np.asarray(image)
-
-      # Return updated Rover and separate image for optional saving
-      return Rover, image
+      try:
+            return float(string_to_convert)
+      except ValueError:
+            return float(string_to_convert.replace(',','.'))
+
+# Define a function to convert a ';' separated telemetry string to a tuple of floats
+def convert_to_floats(string_to_convert):
+      return tuple(convert_to_float(value) for value in string_to_convert.split(';'))
+
+# Numeric telemetry fields decoded on every frame:
+# (telemetry key, Rover attribute, parser)
+telemetry_schema = [
+      ('speed', 'vel', convert_to_float), # The current speed of the rover in m/s
+      ('position', 'pos', convert_to_floats), # The current position of the rover
+      ('yaw', 'yaw', convert_to_float), # The current yaw angle of the rover
+      ('pitch', 'pitch', convert_to_float), # The current pitch angle of the rover
+      ('roll', 'roll', convert_to_float), # The current roll angle of the rover
+      ('throttle', 'throttle', convert_to_float), # The current throttle setting
+      ('steering_angle', 'steer', convert_to_float), # The current steering angle
+      ('near_sample', 'near_sample', int), # Near sample flag
+      ('picking_up', 'picking_up', int), # Picking up flag
+]
+
+# Define a class to decode telemetry messages into the Rover state.
+# Numeric fields are parsed according to telemetry_schema and the camera
+# JPEG is decoded straight into a preallocated uint8 RGB buffer that is
+# reused from frame to frame (so Rover.img is overwritten by the next frame).
+# Status printing and per-field decode timing are both optional.
+class TelemetryDecoder():
+      def __init__(self, schema=telemetry_schema, verbose=False, timing=False):
+            self.schema = schema
+            self.verbose = verbose # Print the status line on every frame
+            self.timing = timing # Record per-field decode times
+            self.img_buffer = None # Reusable RGB image buffer
+            self.field_time = {} # Total decode time per field (seconds)
+            self.frames = 0 # Number of frames decoded with timing on
+
+      # Decode the camera image into the reusable buffer
+      def decode_image(self, jpeg_bytes):
+            bgr = cv2.imdecode(np.frombuffer(jpeg_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if self.img_buffer is None or self.img_buffer.shape != bgr.shape:
+                  self.img_buffer = np.empty_like(bgr)
+            return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=self.img_buffer)
+
+      def update(self, Rover, data):
+            # Initialize start time and sample positions
+            if Rover.start_time == None:
+                  Rover.start_time = time.time()
+                  Rover.total_time = 0
+                  samples_xpos = np.int_(convert_to_floats(data["samples_x"]))
+                  samples_ypos = np.int_(convert_to_floats(data["samples_y"]))
+                  Rover.samples_pos = (samples_xpos, samples_ypos)
+                  Rover.samples_to_find = int(data["sample_count"])
+            # Or just update elapsed time
+            else:
+                  tot_time = time.time() - Rover.start_time
+                  if np.isfinite(tot_time):
+                        Rover.total_time = tot_time
+            if self.timing:
+                  self.frames += 1
+                  for key, attribute, parse in self.schema:
+                        t0 = time.perf_counter()
+                        setattr(Rover, attribute, parse(data[key]))
+                        self.add_time(key, time.perf_counter() - t0)
+            else:
+                  for key, attribute, parse in self.schema:
+                        setattr(Rover, attribute, parse(data[key]))
+            # Update number of rocks collected
+            Rover.samples_collected = Rover.samples_to_find - int(data["sample_count"])
+
+            if self.verbose:
+                  print('speed =',Rover.vel, 'position =', Rover.pos, 'throttle =', 
+                  Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample, 
+                  'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup, 
+                  'total time:', Rover.total_time, 'samples remaining:', data["sample_count"], 
+                  'samples collected:', Rover.samples_collected)
+            # Get the current image from the center camera of the rover
+            t0 = time.perf_counter()
+            Rover.img = self.decode_image(base64.b64decode(data["image"]))
+            if self.timing:
+                  self.add_time('image', time.perf_counter() - t0)
+
+            return Rover
+
+      def add_time(self, key, seconds):
+            self.field_time[key] = self.field_time.get(key, 0) + seconds
+
+      # Return the mean decode time of each field in microseconds
+      def timing_report(self):
+            return {key: 1e6 * total / max(self.frames, 1)
+                    for key, total in self.field_time.items()}
+
+# Default decoder used by update_rover()
+telemetry_decoder = TelemetryDecoder()
+
+def update_rover(Rover, data, decoder=None):
+      if decoder is None:
+            decoder = telemetry_decoder
+      return decoder.update(Rover, data)
+
+# Define a class to keep the map statistics shown by create_output_images
+# up to date incrementally.  All worldmap evidence is added through update(),
+# which only looks at the cells touched in the current frame, so the cost
+# tracks the new observations rather than the size of the map.
+class MapStats():
+      def __init__(self, ground_truth):
+            # Shared ground truth service (worldmap.GroundTruth)
+            self.ground_truth = ground_truth
+            # Ground truth navigable index at the worldmap size (flattened,
+            # like the cell indices), looked up on the first update
+            self.nav_truth = None
+            self.tot_map_pix = ground_truth.tot_nav_pix
+            # Navigable terrain statistics
+            self.tot_nav_pix = 0 # Number of mapped navigable cells
+            self.good_nav_pix = 0 # Number of those that are ground truth cells
+            self.nav_sum = 0. # Sum of navigable evidence over the map
+            # Obstacle statistics
+            self.tot_obs_pix = 0 # Number of mapped obstacle cells
+            self.obs_sum = 0. # Sum of obstacle evidence over the map
+            # Flat indices of rock cells, in the order they were first detected
+            self.rock_cells = []
+            self.rocks_checked = 0 # Number of entries in rock_cells scored so far
+            self.samples_pos = None # Sample positions the index was built for
+            self.sample_index = None # SampleIndex scoring rocks against them
+            self.version = 0 # Incremented whenever the worldmap is updated
+
+      # Add evidence to one channel of the worldmap for the given cells
+      # and update the statistics from the cells that became nonzero
+      def update(self, worldmap, channel, x_world, y_world, amount):
+            if self.nav_truth is None or len(self.nav_truth) != worldmap.shape[0] * worldmap.shape[1]:
+                  self.nav_truth = self.ground_truth.nav_index(worldmap.shape[0])
+                  self.tot_map_pix = np.count_nonzero(self.nav_truth)
+            new_cells, added = add_evidence(worldmap, channel,
+                                            cell_index(worldmap, x_world, y_world), amount)
+            self.version += 1
+            if channel == 2:
+                  self.tot_nav_pix += len(new_cells)
+                  self.good_nav_pix += np.count_nonzero(self.nav_truth[new_cells])
+                  self.nav_sum += added
+            elif channel == 0:
+                  self.tot_obs_pix += len(new_cells)
+                  self.obs_sum += added
+            elif channel == 1 and len(new_cells):
+                  self.rock_cells.append(new_cells)
+
+      # Mean navigable / obstacle evidence over the cells where it is nonzero
+      def nav_mean(self):
+            return self.nav_sum / self.tot_nav_pix
+      def obs_mean(self):
+            return self.obs_sum / self.tot_obs_pix
+
+      # Percentage of ground truth mapped and map fidelity
+      def perc_mapped(self):
+            return round(100*self.good_nav_pix/self.tot_map_pix, 1)
+      def fidelity(self):
+            if self.tot_nav_pix > 0:
+                  return round(100*self.good_nav_pix/self.tot_nav_pix, 1)
+            return 0
+
+      # Return a boolean array flagging which samples have a rock detection
+      # within 3 meters.  Only rock cells detected since the last call are
+      # looked up in the sample grid index.
+      def located_samples(self, samples_pos, world_size):
+            if samples_pos is None:
+                  return np.zeros(0, dtype=bool)
+            if self.samples_pos is not samples_pos or self.sample_index.world_size != world_size:
+                  self.samples_pos = samples_pos
+                  self.sample_index = SampleIndex(samples_pos, world_size)
+                  self.rocks_checked = 0
+            if self.rocks_checked < len(self.rock_cells):
+                  self.sample_index.add_rocks(np.concatenate(self.rock_cells[self.rocks_checked:]))
+                  self.rocks_checked = len(self.rock_cells)
+            return self.sample_index.located
 
 # Define a function to create display output given worldmap results
 def create_output_images(Rover):
+      map_img, vision_img = render_output_images(Rover)
+      # Convert map and vision image to base64 strings for sending to server
+      return encode_image(map_img), encode_image(vision_img)
+
+# Define a function to render the worldmap and vision display images as
+# new uint8 arrays (safe to hand off to another thread for encoding)
+def render_output_images(Rover):
 
-      # Create a scaled map for plotting and clean up obs/nav pixels a bit
-      if np.max(Rover.worldmap[:,:,2]) > 0:
-            nav_pix = Rover.worldmap[:,:,2] > 0
-            navigable = Rover.worldmap[:,:,2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
-      else: 
-            navigable = Rover.worldmap[:,:,2]
-      if np.max(Rover.worldmap[:,:,0]) > 0:
-            obs_pix = Rover.worldmap[:,:,0] > 0
-            obstacle = Rover.worldmap[:,:,0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
-      else:
-            obstacle = Rover.worldmap[:,:,0]
-
-      likely_nav = navigable >= obstacle
-      obstacle[likely_nav] = 0
-      plotmap = np.zeros_like(Rover.worldmap)
-      plotmap[:, :, 0] = obstacle
-      plotmap[:, :, 2] = navigable
-      plotmap = plotmap.clip(0, 255)
+      stats = Rover.map_stats
+      # Scale obstacle and navigable terrain so their mean evidence maps to 255
+      nav_scale = 1
+      if stats.tot_nav_pix > 0:
+            nav_scale = 255 / stats.nav_mean()
+      obs_scale = 1
+      if stats.tot_obs_pix > 0:
+            obs_scale = 255 / stats.obs_mean()
+      # Samples that have been confirmed by a rock detection within 3 meters
+      located = stats.located_samples(Rover.samples_pos, Rover.worldmap.shape[1])
+      samples_located = np.count_nonzero(located)
       # Overlay obstacle and navigable terrain map with ground truth map
-      map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
-
-      # Check whether any rock detections are present in worldmap
-      rock_world_pos = Rover.worldmap[:,:,1].nonzero()
-      # If there are, we'll step through the known sample positions
-      # to confirm whether detections are real
-      samples_located = 0
-      if rock_world_pos[0].any():
-            
-            rock_size = 2
-            for idx in range(len(Rover.samples_pos[0])):
-                  test_rock_x = Rover.samples_pos[0][idx]
-                  test_rock_y = Rover.samples_pos[1][idx]
-                  rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
-                                        (test_rock_y - rock_world_pos[0])**2)
-                  # If rocks were detected within 3 meters of known sample positions
-                  # consider it a success and plot the location of the known
-                  # sample on the map
-                  if np.min(rock_sample_dists) < 3:
-                        samples_located += 1
-                        map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
-
-      # Calculate some statistics on the map results
-      # First get the total number of pixels in the navigable terrain map
-      tot_nav_pix = np.float(len((plotmap[:,:,2].nonzero()[0])))
-      # Next figure out how many of those correspond to ground truth pixels
-      good_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)).nonzero()[0]))
-      # Next find how many do not correspond to ground truth pixels
-      bad_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] == 0)).nonzero()[0]))
-      # Grab the total number of map pixels
-      tot_map_pix = np.float(len((Rover.ground_truth[:,:,1].nonzero()[0])))
-      # Calculate the percentage of ground truth map that has been successfully found
-      perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
-      # Calculate the number of good map pixel detections divided by total pixels 
-      # found to be navigable terrain
-      if tot_nav_pix > 0:
-            fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
-      else:
-            fidelity = 0
-      # Flip the map for plotting so that the y-axis points upward in the display
-      map_add = np.flipud(map_add).astype(np.float32)
+      # in the renderer's cached display buffer
+      map_add = Rover.map_renderer.render(Rover.worldmap, nav_scale, obs_scale,
+                                          Rover.samples_pos, located).copy()
+
+      # Map statistics are kept up to date incrementally by Rover.map_stats
+      perc_mapped = stats.perc_mapped()
+      fidelity = stats.fidelity()
       # Add some text about map and rock sample detection results
       cv2.putText(map_add,"Time: "+str(np.round(Rover.total_time, 1))+' s', (0, 10), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
@@ -140,18 +224,11 @@ def create_output_images(Rover):
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
       cv2.putText(map_add,"  Collected: "+str(Rover.samples_collected), (0, 85), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
-      # Convert map and vision image to base64 strings for sending to server
-      pil_img = Image.fromarray(map_add.astype(np.uint8))
-      buff = BytesIO()
-      pil_img.save(buff, format="JPEG")
-      encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
-      
-      pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
+      return map_add, Rover.vision_image.astype(np.uint8)
+
+# Define a function to JPEG encode an image as a base64 string
+def encode_image(img):
+      pil_img = Image.fromarray(img)
       buff = BytesIO()
       pil_img.save(buff, format="JPEG")
-      encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
-
-      return encoded_string1, encoded_string2
-
-
-
+      return base64.b64encode(buff.getvalue()).decode("utf-8")
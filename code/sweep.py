@@ -0,0 +1,346 @@
+import argparse
+import csv
+import itertools
+import os
+import time
+from collections import namedtuple, OrderedDict
+from multiprocessing import Pool
+import numpy as np
+
+from perception import perception_step, perception_modes, get_warp_table, footprint_world, PoseGate
+from decision import decision_step
+from planner import Planner
+from classifier import ColorClassifier, threshold_rules
+from drive_rover import RoverState, ground_truth
+from replay import read_log, read_image
+from sim_client import GroundTruthCamera
+
+# Parameters of a trial are RoverState attributes (stop_forward, go_forward,
+# throttle_set, brake_set, max_vel, steer_mode, perception_mode, ...) plus
+# rgb_thresh (navigable terrain threshold, one value or one per channel) and
+# max_tilt and min_move (PoseGate, max_tilt 0 integrates every frame).
+# Replay trials score perception against a recorded log, so they only take
+# the parameters that change what gets mapped.  Drive trials render flat
+# ground and wall colors (see GroundTruthCamera), which any threshold either
+# separates perfectly or not at all, so they don't take color parameters.
+replay_params = ('rgb_thresh', 'perception_mode', 'max_tilt', 'min_move')
+color_params = ('rgb_thresh',)
+default_params = {'rgb_thresh': 160, 'perception_mode': 'full', 'max_tilt': 1., 'min_move': 0.05}
+
+# Pose of a recorded frame, as read by PoseGate.check()
+Pose = namedtuple('Pose', ['pos', 'yaw', 'pitch', 'roll'])
+
+# Compiled color classifiers by (integer) threshold, least recently used
+# first.  Each holds a 16 MB lookup table, so only a few are kept.
+classifiers = OrderedDict()
+max_classifiers = 4
+
+# Define a function to return the (cached) classifier of a threshold.
+# threshold_rules() casts the threshold to integers, so thresholds with the
+# same integer part share a classifier.
+def get_classifier(rgb_thresh):
+    key = tuple(int(value) for value in np.broadcast_to(rgb_thresh, 3))
+    if key in classifiers:
+        classifiers.move_to_end(key)
+    else:
+        classifiers[key] = ColorClassifier(threshold_rules(key))
+        if len(classifiers) > max_classifiers:
+            classifiers.popitem(last=False)
+    return classifiers[key]
+
+# Define a function to build the PoseGate of a trial (None without one)
+def make_pose_gate(params):
+    if params['max_tilt'] <= 0:
+        return None
+    return PoseGate(params['max_tilt'], params['min_move'])
+
+# Define a function to return the percentage of ground truth mapped and the
+# map fidelity of a flattened boolean navigable map (as create_output_images)
+def map_scores(navigable, truth):
+    good_nav_pix = np.count_nonzero(navigable & truth)
+    tot_nav_pix = np.count_nonzero(navigable)
+    mapped = round(100 * good_nav_pix / np.count_nonzero(truth), 1)
+    fidelity = round(100 * good_nav_pix / tot_nav_pix, 1) if tot_nav_pix > 0 else 0
+    return mapped, fidelity
+
+# Define a class holding what replay trials share: the decoded frames of a
+# log, and per perception mode the footprint pixels of every frame and the
+# worldmap cell each of them lands in.  None of these depend on the trial
+# parameters, so a trial only thresholds the cached pixels and marks cells.
+# A pixel is above a single threshold in all channels if its darkest channel
+# is, so that channel is cached too.
+class ReplayCache():
+    def __init__(self, records, world_size=200):
+        self.world_size = world_size
+        self.imgs = np.stack([read_image(record.path) for record in records])
+        self.poses = [Pose((record.xpos, record.ypos), record.yaw, record.pitch, record.roll)
+                      for record in records]
+        self.xpos = np.array([record.xpos for record in records])
+        self.ypos = np.array([record.ypos for record in records])
+        self.yaw = np.array([record.yaw for record in records])
+        self.truth = ground_truth.nav_index(world_size)
+        self.footprints = {} # Perception mode -> (pixels, darkest channel, cells)
+
+    # Return the (frames, N, 3) footprint pixels, their (frames, N) darkest
+    # channel and (frames, N) flat worldmap cells of a perception mode
+    def footprint(self, mode):
+        if mode not in self.footprints:
+            table = get_warp_table(mode)
+            x_world, y_world = footprint_world(table, self.xpos, self.ypos, self.yaw, self.world_size)
+            cells = (y_world * self.world_size + x_world).astype(np.int32)
+            pixels = table.gather_stack(self.imgs)
+            self.footprints[mode] = (pixels, pixels.min(axis=-1), cells)
+        return self.footprints[mode]
+
+    # Run one trial and return its (mapped, fidelity)
+    def run(self, params):
+        gate = make_pose_gate(params)
+        frames = [idx for idx, pose in enumerate(self.poses)
+                  if gate is None or gate.check(pose) is None]
+        pixels, darkest, cells = self.footprint(params['perception_mode'])
+        if len(frames) < len(self.poses):
+            pixels, darkest, cells = pixels[frames], darkest[frames], cells[frames]
+        # Navigable terrain as classified by threshold_rules()
+        rgb_thresh = np.asarray(params['rgb_thresh'])
+        if rgb_thresh.ndim == 0:
+            navigable = darkest > rgb_thresh
+        else:
+            navigable = np.all(pixels > rgb_thresh, axis=-1)
+        mapped = np.zeros(self.world_size * self.world_size, dtype=bool)
+        mapped[cells[navigable]] = True
+        return map_scores(mapped, self.truth)
+
+# Kinematic stand-in for the simulator rover used by drive trials
+accel_per_throttle = 10. # Acceleration (m/s^2) per unit of throttle
+decel_per_brake = 1. # Deceleration (m/s^2) per unit of brake
+drag = 0.2 # Fraction of speed lost per second
+turn_rate = 2. # Yaw rate (degrees/second) per degree of steering
+
+# Define a class holding what drive trials share: the ground truth camera
+# (its projection of every camera pixel onto the ground is computed once)
+# and the seeded start poses every trial drives from.  A trial drives the
+# perception and decision steps in closed loop for a number of steps from
+# each start, moving the rover with the kinematic model above (it stops dead
+# when driving into non-navigable ground), and scores the worldmap with the
+# incremental map statistics shown by create_output_images.
+class DriveCache():
+    def __init__(self, steps=600, fps=20, starts=1, seed=0):
+        self.camera = GroundTruthCamera(ground_truth)
+        self.steps = steps
+        self.dt = 1 / fps
+        rng = np.random.RandomState(seed)
+        nav_y, nav_x = np.nonzero(ground_truth.nav)
+        picks = rng.randint(len(nav_x), size=starts)
+        self.starts = [(nav_x[idx] + 0.5, nav_y[idx] + 0.5, rng.uniform(0, 360)) for idx in picks]
+
+    # Drive one trial from one start pose and return the Rover
+    def drive(self, params, start):
+        Rover = RoverState()
+        for name, value in params.items():
+            if name not in default_params:
+                setattr(Rover, name, value)
+        Rover.perception_mode = params['perception_mode']
+        Rover.classifier = get_classifier(params['rgb_thresh'])
+        Rover.pose_gate = make_pose_gate(params)
+        # Plan trials steer towards frontiers, as with drive_rover.py --plan
+        if Rover.steer_mode == 'plan':
+            Rover.planner = Planner(Rover.worldmap.shape[0])
+        x, y, yaw = start
+        vel = 0.
+        for step in range(self.steps):
+            Rover.img = self.camera.render(x, y, yaw)
+            Rover.pos, Rover.yaw, Rover.pitch, Rover.roll, Rover.vel = (x, y), yaw, 0., 0., vel
+            Rover.total_time = step * self.dt
+            perception_step(Rover)
+            if Rover.planner is not None:
+                Rover.planner.update(Rover)
+            decision_step(Rover)
+            # Apply the commands for one frame
+            vel += (Rover.throttle * accel_per_throttle
+                    - Rover.brake * decel_per_brake * np.sign(vel)) * self.dt
+            if Rover.brake > 0 and abs(vel) < Rover.brake * decel_per_brake * self.dt:
+                vel = 0.
+            vel -= drag * vel * self.dt
+            yaw = (yaw + Rover.steer * turn_rate * self.dt) % 360
+            yaw_rad = yaw * np.pi / 180
+            next_x, next_y = x + vel * np.cos(yaw_rad) * self.dt, y + vel * np.sin(yaw_rad) * self.dt
+            if self.camera.navigable(next_x, next_y):
+                x, y = next_x, next_y
+            else:
+                vel = 0.
+        return Rover
+
+    # Run one trial and return its (mapped, fidelity) averaged over the starts
+    def run(self, params):
+        scores = []
+        for start in self.starts:
+            Rover = self.drive(params, start)
+            scores.append((Rover.map_stats.perc_mapped(), Rover.map_stats.fidelity()))
+        mapped, fidelity = np.mean(scores, axis=0)
+        return round(float(mapped), 1), round(float(fidelity), 1)
+
+# Trial cache of this process (set before the pool forks, or by init_worker)
+trial_cache = None
+
+def init_worker(cache):
+    global trial_cache
+    trial_cache = cache
+
+# Worker entry point for the process pool
+def run_trial(args):
+    idx, params = args
+    t0 = time.perf_counter()
+    mapped, fidelity = trial_cache.run(dict(default_params, **params))
+    return {'trial': idx, 'params': params, 'mapped': mapped, 'fidelity': fidelity,
+            'seconds': round(time.perf_counter() - t0, 3)}
+
+# Define a function to run trials across a process pool and return their
+# results ranked by score: the percentage mapped among trials reaching
+# min_fidelity (the project requires 40% mapped at 60% fidelity), then the
+# fidelity of the rest
+def run_sweep(cache, trials, workers=None, min_fidelity=60):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(trials)))
+    init_worker(cache)
+    if workers == 1:
+        results = [run_trial(trial) for trial in enumerate(trials)]
+    else:
+        with Pool(workers, initializer=init_worker, initargs=(cache,)) as pool:
+            results = list(pool.imap_unordered(run_trial, enumerate(trials)))
+    for result in results:
+        result['score'] = result['mapped'] if result['fidelity'] >= min_fidelity else 0
+    return sorted(results, key=lambda result: (result['score'], result['fidelity']), reverse=True)
+
+# Define a function to convert a parameter value from the command line
+def parse_value(string):
+    for convert in (int, float):
+        try:
+            return convert(string)
+        except ValueError:
+            pass
+    return string
+
+# Define a function to parse name=v1,v2,... (values to try) or name=low:high
+# (a range to sample uniformly, integers if both ends are) parameter specs
+def parse_space(specs):
+    space = {}
+    for spec in specs:
+        name, values = spec.split('=', 1)
+        if ':' in values:
+            low, high = (parse_value(value) for value in values.split(':', 1))
+            space[name] = (low, high)
+        else:
+            space[name] = [parse_value(value) for value in values.split(',')]
+    return space
+
+# Define a function to return every combination of a space of value lists
+def grid_trials(space):
+    for name, values in space.items():
+        if not isinstance(values, list):
+            raise ValueError('Grid sweeps need a list of values for {}'.format(name))
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*space.values())]
+
+# Define a function to draw count random trials from a space
+def random_trials(space, count, seed=0):
+    rng = np.random.RandomState(seed)
+    trials = []
+    for idx in range(count):
+        params = {}
+        for name, values in space.items():
+            if isinstance(values, list):
+                params[name] = values[rng.randint(len(values))]
+            elif isinstance(values[0], int) and isinstance(values[1], int):
+                params[name] = int(rng.randint(values[0], values[1] + 1))
+            else:
+                params[name] = round(float(rng.uniform(values[0], values[1])), 3)
+        trials.append(params)
+    return trials
+
+# Define a function to check the parameters of a space exist for a target
+def check_space(space, target):
+    Rover = RoverState()
+    for name in space:
+        if target == 'replay' and name not in replay_params:
+            raise ValueError('Replay sweeps only take {}, not {}'.format(', '.join(replay_params), name))
+        if target == 'drive' and name in color_params:
+            raise ValueError('Drive sweeps render flat colors, so they don\'t take {}'.format(name))
+        if name not in default_params and not hasattr(Rover, name):
+            raise ValueError('Unknown parameter {}'.format(name))
+    for mode in space.get('perception_mode', []):
+        if mode not in perception_modes:
+            raise ValueError('Unknown perception mode {}'.format(mode))
+
+def format_params(params):
+    return ' '.join('{}={}'.format(name, value) for name, value in sorted(params.items()))
+
+def print_results(results, top=None):
+    print("{:>5} {:>6} {:>10} {:>10} {:>8}  {}".format('rank', 'trial', 'mapped %', 'fidelity %',
+                                                        'seconds', 'parameters'))
+    for rank, result in enumerate(results[:top], 1):
+        print("{:>5} {:>6} {:>10} {:>10} {:>8}  {}".format(
+            rank, result['trial'], result['mapped'], result['fidelity'], result['seconds'],
+            format_params(result['params'])))
+
+# Define a function to save the ranked results as CSV, one column per parameter
+def save_results(path, results):
+    names = sorted(set(name for result in results for name in result['params']))
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank', 'trial', 'mapped', 'fidelity', 'seconds'] + names)
+        for rank, result in enumerate(results, 1):
+            writer.writerow([rank, result['trial'], result['mapped'], result['fidelity'],
+                             result['seconds']] + [result['params'].get(name, '') for name in names])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parameter sweeps scored by map coverage and fidelity')
+    parser.add_argument(
+        'target',
+        type=str,
+        choices=['replay', 'drive'],
+        help='replay: score perception parameters on a recorded log. drive: drive the '
+             'perception and decision steps in closed loop on the ground truth map.'
+    )
+    parser.add_argument('--param', type=str, action='append', default=[],
+                        help='Parameter to sweep, as name=v1,v2,... or name=low:high '
+                             '(ranges need --random). Repeat for each parameter.')
+    parser.add_argument('--random', type=int, default=0,
+                        help='Draw this many random trials instead of the full grid.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of random trials and start poses.')
+    parser.add_argument('--log', type=str, default='../test_dataset/robot_log.csv',
+                        help='robot_log.csv or recording folder replayed by replay sweeps.')
+    parser.add_argument('--steps', type=int, default=600,
+                        help='Frames driven per start pose in drive sweeps (20 per second).')
+    parser.add_argument('--starts', type=int, default=1,
+                        help='Start poses averaged over in drive sweeps.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: all cores).')
+    parser.add_argument('--min_fidelity', type=float, default=60,
+                        help='Fidelity (%%) a trial needs to be ranked by percentage mapped.')
+    parser.add_argument('--top', type=int, default=20, help='Rows of the ranked table to print.')
+    parser.add_argument('--output', type=str, default='',
+                        help='Save all ranked results to this CSV file.')
+    args = parser.parse_args()
+
+    space = parse_space(args.param)
+    check_space(space, args.target)
+    if args.random > 0:
+        trials = random_trials(space, args.random, args.seed)
+    else:
+        trials = grid_trials(space)
+    start = time.time()
+    if args.target == 'replay':
+        cache = ReplayCache(read_log(args.log))
+        # Fill the per mode caches before the workers fork so they share them
+        for mode in set(trial.get('perception_mode', 'full') for trial in trials):
+            cache.footprint(mode)
+    else:
+        cache = DriveCache(args.steps, starts=args.starts, seed=args.seed)
+    print("Running {} {} trials (setup {:.1f} s)".format(len(trials), args.target, time.time() - start))
+    results = run_sweep(cache, trials, args.workers, args.min_fidelity)
+    print_results(results, args.top)
+    print("Sweep took {:.1f} s".format(time.time() - start))
+    if args.output != '':
+        save_results(args.output, results)
+        print("Saved results to {}".format(args.output))
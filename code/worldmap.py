@@ -0,0 +1,188 @@
+import threading
+import numpy as np
+import cv2
+
+# Size of the simulator world in meters.  A worldmap with N cells per side
+# has N / world_meters cells per meter, so maps can be made finer than the
+# 1 cell per meter of the ground truth map just by making them larger.
+world_meters = 200
+# Worldmap evidence is kept as saturating uint16 counters per class
+# (channel 0: obstacle, 1: rock sample, 2: navigable terrain)
+map_dtype = np.uint16
+
+# Define a function to create an empty worldmap with world_size cells per side
+def new_worldmap(world_size=200):
+    return np.zeros((world_size, world_size, 3), dtype=map_dtype)
+
+# Define a function to return the number of worldmap cells per meter
+def map_resolution(worldmap):
+    return worldmap.shape[0] / world_meters
+
+# Per-thread scratch buffers for cell_index(), one entry per map size
+scratch = threading.local()
+
+# Define a function to convert world pixel coords to unique flat cell indices.
+# Instead of sorting, every pixel writes its position into a map sized scratch
+# buffer and the pixels that read their own position back are kept, so exactly
+# one pixel per cell survives in O(n).
+def cell_index(worldmap, x_world, y_world):
+    cells = y_world * worldmap.shape[1] + x_world
+    owners = getattr(scratch, 'owners', None)
+    if owners is None or len(owners) != worldmap.shape[0] * worldmap.shape[1]:
+        owners = np.empty(worldmap.shape[0] * worldmap.shape[1], dtype=np.intp)
+        scratch.owners = owners
+    order = np.arange(len(cells))
+    owners[cells] = order
+    return cells[owners[cells] == order]
+
+# Define a function to add evidence to one channel of the worldmap for a
+# set of unique flat cell indices, in place.  Integer maps saturate at the
+# maximum of their dtype instead of wrapping around.  Returns the cells that
+# were previously empty and the total amount of evidence actually added.
+def add_evidence(worldmap, channel, cells, amount):
+    flat_map = worldmap.reshape(-1, worldmap.shape[2])
+    values = flat_map[cells, channel]
+    new_cells = cells[values == 0]
+    if np.issubdtype(worldmap.dtype, np.integer):
+        limit = np.iinfo(worldmap.dtype).max
+        updated = np.minimum(values, limit - amount) + amount
+    else:
+        updated = values + amount
+    flat_map[cells, channel] = updated
+    added = float(np.sum(updated, dtype=np.float64) - np.sum(values, dtype=np.float64))
+    return new_cells, added
+
+# Define a function to add one worldmap into another, in place (saturating)
+def merge_worldmaps(worldmap, other):
+    if np.issubdtype(worldmap.dtype, np.integer):
+        limit = np.iinfo(worldmap.dtype).max
+        np.minimum(worldmap, limit - other, out=worldmap)
+    worldmap += other
+    return worldmap
+
+# Define a function to resample a ground truth style image (one pixel per
+# meter) to the size of the worldmap
+def scale_to_map(image, world_size):
+    if image.shape[0] == world_size:
+        return image
+    return cv2.resize(image, (world_size, world_size), interpolation=cv2.INTER_NEAREST)
+
+# Define a class holding the ground truth map (navigable terrain at 1 pixel
+# per meter) and everything derived from it.  It is built once per process
+# and shared by all rovers: the navigable mask, its pixel count, the green
+# display image and the navigable index at each worldmap size are only
+# computed once.
+class GroundTruth():
+    def __init__(self, nav):
+        self.nav = np.asarray(nav) > 0 # Navigable terrain mask
+        self.size = self.nav.shape[0] # Pixels per side (one per meter)
+        self.tot_nav_pix = int(np.count_nonzero(self.nav)) # Navigable pixel count
+        # Navigable terrain in the green channel, for overplotting
+        self.image = np.zeros((self.size, self.size, 3), dtype=np.uint8)
+        self.image[:,:,1] = self.nav * 255
+        self.indices = {} # World size -> flattened navigable mask
+
+    # Return the navigable mask at world_size cells per side, flattened like
+    # the cell indices returned by cell_index()
+    def nav_index(self, world_size):
+        index = self.indices.get(world_size)
+        if index is None:
+            index = scale_to_map(self.nav.astype(np.uint8), world_size).ravel() > 0
+            self.indices[world_size] = index
+        return index
+
+# Loaded ground truth maps, by path
+ground_truths = {}
+
+# Define a function to load a ground truth map image once per process
+def load_ground_truth(path):
+    if path not in ground_truths:
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise IOError('Could not read ground truth map {}'.format(path))
+        ground_truths[path] = GroundTruth(image)
+    return ground_truths[path]
+
+# Define a class to score rock detections against the sample positions with
+# a grid index.  Every worldmap cell holds a bitmask of the samples within
+# `radius` meters of it, so each detected rock cell costs a single lookup no
+# matter how many samples or earlier detections there are (up to 64 samples).
+class SampleIndex():
+    def __init__(self, samples_pos, world_size, radius=3):
+        nsamples = len(samples_pos[0])
+        if nsamples > 64:
+            raise ValueError('SampleIndex supports up to 64 samples, got {}'.format(nsamples))
+        self.world_size = world_size
+        self.located = np.zeros(nsamples, dtype=bool) # Located flag for each sample
+        self.bits = np.uint64(1) << np.arange(nsamples, dtype=np.uint64)
+        self.near = np.zeros(world_size * world_size, dtype=np.uint64)
+        cell_meters = world_meters / world_size
+        for idx in range(nsamples):
+            sample_x, sample_y = samples_pos[0][idx], samples_pos[1][idx]
+            # Cells in the bounding box of the circle around the sample,
+            # positioned in meters like the sample
+            x_lo = min(max(int(np.floor((sample_x - radius) / cell_meters)), 0), world_size)
+            x_hi = min(max(int(np.ceil((sample_x + radius) / cell_meters)) + 1, 0), world_size)
+            y_lo = min(max(int(np.floor((sample_y - radius) / cell_meters)), 0), world_size)
+            y_hi = min(max(int(np.ceil((sample_y + radius) / cell_meters)) + 1, 0), world_size)
+            cell_y, cell_x = np.mgrid[y_lo:y_hi, x_lo:x_hi]
+            dists = np.sqrt((sample_x - cell_x * cell_meters)**2 + \
+                            (sample_y - cell_y * cell_meters)**2)
+            self.near[(cell_y * world_size + cell_x)[dists < radius]] |= self.bits[idx]
+
+    # Mark the samples within radius of any of the given rock cells as located
+    def add_rocks(self, cells):
+        if len(cells) and not self.located.all():
+            hit = np.bitwise_or.reduce(self.near[cells])
+            self.located |= (hit & self.bits) > 0
+        return self.located
+
+# Define a class that renders the worldmap display image into cached
+# buffers.  The float32 scratch planes, the uint8 plot and the display image
+# are allocated once per map size and reused on every render.  The display
+# is always the size of the ground truth map (1 pixel per meter).
+class MapRenderer():
+    def __init__(self, ground_truth):
+        # Ground truth overlay at half intensity in the green channel
+        self.overlay = ground_truth.image[:,:,1] // 2
+        self.display_size = ground_truth.size
+        self.display = np.zeros((self.display_size, self.display_size, 3), dtype=np.uint8)
+        self.world_size = None
+
+    def allocate(self, world_size):
+        self.world_size = world_size
+        self.navigable = np.empty((world_size, world_size), dtype=np.float32)
+        self.obstacle = np.empty((world_size, world_size), dtype=np.float32)
+        self.likely_nav = np.empty((world_size, world_size), dtype=bool)
+        self.plotmap = np.zeros((world_size, world_size, 3), dtype=np.uint8)
+        self.plotmap[:,:,1] = scale_to_map(self.overlay, world_size)
+
+    # Render obstacle and navigable terrain (scaled so their mean evidence
+    # maps to 255) over the ground truth and mark the located samples.
+    # Returns the cached display image, flipped so the y-axis points up.
+    def render(self, worldmap, nav_scale, obs_scale, samples_pos=None, located=()):
+        if self.world_size != worldmap.shape[0]:
+            self.allocate(worldmap.shape[0])
+        np.multiply(worldmap[:,:,2], nav_scale, out=self.navigable, dtype=np.float32)
+        np.multiply(worldmap[:,:,0], obs_scale, out=self.obstacle, dtype=np.float32)
+        # Clean up obs/nav pixels a bit
+        np.greater_equal(self.navigable, self.obstacle, out=self.likely_nav)
+        np.copyto(self.obstacle, 0, where=self.likely_nav)
+        np.clip(self.navigable, 0, 255, out=self.navigable)
+        np.clip(self.obstacle, 0, 255, out=self.obstacle)
+        np.copyto(self.plotmap[:,:,0], self.obstacle, casting='unsafe')
+        np.copyto(self.plotmap[:,:,2], self.navigable, casting='unsafe')
+        plotmap = self.plotmap
+        if self.world_size != self.display_size:
+            plotmap = cv2.resize(plotmap, (self.display_size, self.display_size),
+                                 interpolation=cv2.INTER_AREA)
+        # Flip the map for plotting so that the y-axis points upward in the display
+        np.copyto(self.display, plotmap[::-1])
+        # Plot the location of each located sample
+        rock_size = 2
+        for idx in np.flatnonzero(located):
+            test_rock_x = samples_pos[0][idx]
+            test_rock_y = self.display_size - 1 - samples_pos[1][idx]
+            self.display[test_rock_y-rock_size+1:test_rock_y+rock_size+1,
+                         test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+        return self.display